@@ -0,0 +1,129 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Size, serialization time and broker memory of the task payload formats (see bilge.payload)
+#  run from the repo root : python -m benchmarks.bench_payload --posts 5000
+#  the broker stage uses a scratch queue on the redis in config.json (deleted after), --no-broker skips it
+
+import argparse
+import random
+import timeit
+
+from kombu.serialization import dumps, loads
+
+import bilge
+from bilge.main import Bilge
+from bilge.payload import PAYLOAD_MODES, decode_payload, encode_payload
+from benchmarks.bench_pipeline import make_stream
+
+config = bilge.config
+
+SCRATCH_QUEUE = 'bench.payload'
+# sent by name, the task message is the same as the ingestion's apply_async
+TASK_NAME = 'bilge.tasks.calculate_and_insert_sentiments'
+# celery's task message body (protocol 2) : args, kwargs and the canvas options
+EMBED = {'callbacks': None, 'errbacks': None, 'chain': None, 'chord': None}
+ACCEPT = ['application/json', 'application/x-msgpack']
+
+
+def make_batches(n_posts, batch_size, rng):
+    # post dicts in the shape the ingestion sends them, in tasks of 'batch_size' posts of one language
+    posts = [Bilge.redis_post_to_model_dict(p) for message in make_stream(n_posts, rng) for p in message]
+    groups = {}
+    for p in posts:
+        groups.setdefault(p['language'], []).append(p)
+    return [group[i:i + batch_size] for group in groups.values() for i in range(0, len(group), batch_size)]
+
+
+def serializer_of(mode):
+    return 'msgpack' if mode == 'packed' else 'json'
+
+
+def measure_serialization(mode, batches, repeat=5):
+    # encode + serialize on the sending side, deserialize + decode on the worker (without the db read of 'ids')
+    serializer = serializer_of(mode)
+    bodies = [dumps(((encode_payload(b, mode),), {}, EMBED), serializer=serializer) for b in batches]
+
+    def decode(body):
+        (payload,), _, _ = loads(body[2], body[0], body[1], accept=ACCEPT)
+        return payload if mode == 'ids' else decode_payload(payload)
+
+    send = min(timeit.repeat(lambda: [dumps(((encode_payload(b, mode),), {}, EMBED), serializer=serializer)
+                                      for b in batches], number=1, repeat=repeat))
+    receive = min(timeit.repeat(lambda: [decode(body) for body in bodies], number=1, repeat=repeat))
+    return sum(len(body[2]) for body in bodies), send, receive
+
+
+def measure_db_fetch(batches, repeat=3):
+    # 'ids' tasks read their posts from postgres : the latest post ids, in the benchmark's batch sizes
+    from bilge.database import Posts, db
+    n_posts = sum(len(b) for b in batches)
+    ids = [row.id for row in Posts.select(Posts.id).order_by(Posts.id.desc()).limit(n_posts)]
+    id_batches = []
+    for b in batches:
+        id_batches.append(ids[:len(b)])
+        ids = ids[len(b):]
+    id_batches = [b for b in id_batches if b]
+    fetched = sum(len(b) for b in id_batches)
+    if not fetched:
+        return None
+    best = min(timeit.repeat(lambda: [db.get_posts_by_ids(b) for b in id_batches], number=1, repeat=repeat))
+    return best / fetched
+
+
+def broker_clients():
+    # a celery app on bilge's broker (same message format as the task's apply_async) and a redis client
+    import redis
+    from celery import Celery
+    app = Celery('bilge', broker=f'redis://{config.redis_host}:{config.redis_port}/{config.redis_db}')
+    return app, redis.Redis(host=config.redis_host, port=config.redis_port, db=config.redis_db)
+
+
+def measure_broker(app, redis_client, mode, batches):
+    # memory of the queued task messages : the scratch queue's list (MEMORY USAGE),
+    # and the growth of the redis server's used_memory (INFO memory)
+    redis_client.delete(SCRATCH_QUEUE)
+    before = redis_client.info('memory')['used_memory']
+    for b in batches:
+        app.send_task(TASK_NAME, (encode_payload(b, mode),), queue=SCRATCH_QUEUE, serializer=serializer_of(mode))
+    try:
+        assert redis_client.llen(SCRATCH_QUEUE) == len(batches)
+        used = redis_client.info('memory')['used_memory'] - before
+        return redis_client.memory_usage(SCRATCH_QUEUE, samples=0), used
+    finally:
+        redis_client.delete(SCRATCH_QUEUE, f'_kombu.binding.{SCRATCH_QUEUE}')
+
+
+def report(rows):
+    print(f"{'mode':<8}{'bytes/post':>12}{'send (us/post)':>16}{'receive (us/post)':>19}"
+          f"{'queue (B/post)':>16}{'redis (B/post)':>16}")
+    for mode, size, send, receive, queue, used in rows:
+        print(f"{mode:<8}{size:>12.0f}{send * 1e6:>16.2f}{receive * 1e6:>19.2f}"
+              + (f"{queue:>16.0f}{used:>16.0f}" if queue is not None else f"{'-':>16}{'-':>16}"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="bilge task payload benchmark")
+    parser.add_argument('--posts', type=int, default=5000, help="number of synthetic posts")
+    parser.add_argument('--batch-size', type=int, default=64, help="posts per task")
+    parser.add_argument('--no-broker', action='store_true', help="skip the broker memory stage")
+    parser.add_argument('--db', action='store_true', help="also time the postgres read of the 'ids' tasks")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    batches = make_batches(args.posts, args.batch_size, random.Random(args.seed))
+    n_posts = sum(len(b) for b in batches)
+
+    app, redis_client = broker_clients() if not args.no_broker else (None, None)
+    rows = []
+    for mode in PAYLOAD_MODES:
+        size, send, receive = measure_serialization(mode, batches)
+        queue = used = None
+        if not args.no_broker:
+            queue, used = measure_broker(app, redis_client, mode, batches)
+            queue, used = queue / n_posts, used / n_posts
+        rows.append((mode, size / n_posts, send / n_posts, receive / n_posts, queue, used))
+
+    print(f"posts : {n_posts}, tasks : {len(batches)}")
+    report(rows)
+    if args.db:
+        fetch = measure_db_fetch(batches)
+        print(f"ids : postgres read {fetch * 1e6:.2f} us/post" if fetch is not None else "ids : no posts in the db")
@@ -0,0 +1,211 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Throughput benchmark of the post -> analysis -> db pipeline (bilge.tasks' calculate and insert functions)
+#  run from the repo root : python -m benchmarks.bench_pipeline --posts 2000 --models stub
+#  the db stage writes to tables in a scratch schema (--schema, dropped after the run) of the database in config.json,
+#  --no-db skips the writes and doesn't need postgres (only a config.json), --cache also needs redis
+
+import argparse
+import json
+import math
+import random
+import resource
+import time
+import zlib
+from datetime import datetime
+
+import bilge
+from bilge import database, tasks
+from bilge.main import Bilge
+from benchmarks.bench_preprocess import make_post
+
+config = bilge.config
+
+SOURCES = ['Twitter', 'Reddit', 'Eksisozluk', 'BBC', 'Hurriyet']
+
+
+class StubSentimentAnalyzer:
+    # deterministic stand-in with the analyzer interface, for CI-scale runs without the models
+    def __init__(self, model_id, labels):
+        self.model_id = model_id
+        self.labels = labels
+
+    def get_sentiments(self, texts):
+        sentiments = []
+        for text in texts:
+            h = zlib.crc32(text.encode('utf8'))
+            logits = [((h >> (8 * i)) & 0xff) / 64 for i in range(len(self.labels))]
+            total = sum(math.exp(x) for x in logits)
+            sentiment = {label: math.exp(x) / total for label, x in zip(self.labels, logits)}
+            sentiment.setdefault('neutral', None)
+            sentiments.append(sentiment)
+        return sentiments
+
+
+class StubNERAnalyzer:
+    model_id = 'stub-ner'
+
+    def get_named_entities_batch(self, texts):
+        for text in texts:
+            entities = []
+            start = 0
+            for word in text.split(' '):
+                if word[:1].isupper():
+                    entities.append((word, 'ORG', start, start + len(word)))
+                start += len(word) + 1
+            yield entities
+
+
+def use_stub_analyzers():
+    # the stubs take the analyzers' place in bilge.tasks, the real models are loaded on first use otherwise
+    tasks.analyzers[('sentiment', 'en')] = StubSentimentAnalyzer('stub-sentiment-en',
+                                                                 ['negative', 'neutral', 'positive'])
+    tasks.analyzers[('sentiment', 'tr')] = StubSentimentAnalyzer('stub-sentiment-tr', ['negative', 'positive'])
+    tasks.analyzers[('ner', 'en')] = StubNERAnalyzer()
+
+
+def make_stream(n_posts, rng):
+    # pub/sub messages of 1-5 posts, in the shape mergen publishes them
+    now = datetime.utcnow().isoformat()
+    messages = []
+    post_id = 0
+    while post_id < n_posts:
+        message = []
+        for _ in range(min(rng.randint(1, 5), n_posts - post_id)):
+            post_id += 1
+            message.append({'ID': post_id, 'CreatedAt': now, 'UpdatedAt': now, 'DeletedAt': None,
+                            'Title': make_post(rng)[:80].title(), 'Author': 'bench', 'Source': rng.choice(SOURCES),
+                            'Text': make_post(rng), 'Url': f'https://bench.bilge/{post_id}-{rng.random()}',
+                            'Timestamp': int(time.time()), 'Score': rng.randint(0, 100),
+                            'Language': rng.choice(['en', 'en', 'tr'])})
+        messages.append(message)
+    return messages
+
+
+def load_stream(path):
+    # recorded stream : one pub/sub message (json list of posts) per line
+    with open(path, encoding='utf8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def scratch_models():
+    # bilge's models, all bound to database.bilge_db
+    return [m for m in vars(database).values() if isinstance(m, type) and issubclass(m, database.Model)
+            and m is not database.Model and m._meta.database is database.bilge_db]
+
+
+def create_scratch_db(schema):
+    """
+        A dedicated (non pooled) connection whose search_path is a new schema : the posts table and then
+        bilge's tables are created there, and the models and database.db use it for the run,
+        mergen's and bilge's own tables are never touched
+    """
+    scratch = database.PostgresqlDatabase(config.db_name, user=config.db_user, password=config.db_password,
+                                          host=config.db_host, port=config.db_port,
+                                          options=f'-c search_path={schema}')
+    scratch.execute_sql(f'CREATE SCHEMA {schema}')
+    scratch.bind(scratch_models())
+    database.bilge_db = scratch
+    database.Posts.create_table()
+    # as in mergen's table : nullable deleted_at, unbounded texts
+    scratch.execute_sql('ALTER TABLE posts ALTER COLUMN deleted_at DROP NOT NULL, '
+                        'ALTER COLUMN title TYPE text, ALTER COLUMN text TYPE text, ALTER COLUMN url TYPE text')
+    database.db = database.BilgeDB()
+    return scratch
+
+
+def drop_scratch_db(scratch, schema):
+    scratch.execute_sql(f'DROP SCHEMA {schema} CASCADE')
+    scratch.close()
+
+
+def insert_posts(messages):
+    # the posts have to exist for the sentiment/named_entity foreign keys, ids are assigned by postgres
+    for message in messages:
+        rows = [{'created_at': p['CreatedAt'], 'updated_at': p['UpdatedAt'], 'deleted_at': p['DeletedAt'],
+                 'title': p['Title'], 'author': p['Author'], 'source': p['Source'], 'text': p['Text'],
+                 'url': p['Url'], 'timestamp': p['Timestamp'], 'score': p['Score'], 'language': p['Language']}
+                for p in message]
+        for p, row in zip(message, database.Posts.insert_many(rows).returning(database.Posts.id).execute()):
+            p['ID'] = row.id
+
+
+def run(messages, batch_size, write=True, use_cache=False):
+    timings = {stage: [] for stage in ['parse', 'sentiment', 'ner', 'db', 'total']}
+    payloads = [json.dumps(m) for m in messages]
+    batch = []
+    n_posts = 0
+    start = time.perf_counter()
+
+    def timed(stage, fn, *args):
+        t = time.perf_counter()
+        result = fn(*args)
+        timings[stage].append(time.perf_counter() - t)
+        return result
+
+    def process(batch):
+        batch_start = time.perf_counter()
+        posts = timed('parse', lambda: [Bilge.redis_post_to_model_dict(p) for payload in batch
+                                        for p in json.loads(payload)])
+        # the tasks' own preprocessing, language routing and result shapes
+        sentiments = timed('sentiment', tasks.calculate_sentiments, posts, use_cache)
+        named_entities = timed('ner', tasks.calculate_named_entities, posts, use_cache)
+        if write:
+            timed('db', lambda: (tasks.insert_sentiments(*sentiments), tasks.insert_named_entities(*named_entities)))
+        timings['total'].append(time.perf_counter() - batch_start)
+        return len(posts)
+
+    batch_posts = 0
+    for payload, message in zip(payloads, messages):
+        batch.append(payload)
+        batch_posts += len(message)
+        if batch_posts >= batch_size:
+            n_posts += process(batch)
+            batch = []
+            batch_posts = 0
+    if batch:
+        n_posts += process(batch)
+
+    return n_posts, time.perf_counter() - start, timings
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def report(n_posts, elapsed, timings):
+    print(f"posts : {n_posts}, elapsed : {elapsed:.2f}s, throughput : {n_posts / elapsed:.1f} posts/sec")
+    print(f"{'stage':<12}{'p50 (ms)':>12}{'p99 (ms)':>12}{'share':>10}")
+    total = sum(timings['total']) or 1
+    for stage, values in timings.items():
+        if values:
+            print(f"{stage:<12}{percentile(values, 0.5) * 1e3:>12.2f}{percentile(values, 0.99) * 1e3:>12.2f}"
+                  f"{sum(values) / total:>10.0%}")
+    print(f"peak rss : {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="bilge pipeline benchmark")
+    parser.add_argument('--posts', type=int, default=2000, help="number of synthetic posts")
+    parser.add_argument('--input', help="recorded stream (jsonl, one pub/sub message per line)")
+    parser.add_argument('--batch-size', type=int, default=64, help="posts per pipeline batch")
+    parser.add_argument('--models', choices=['stub', 'real'], default='stub')
+    parser.add_argument('--no-db', action='store_true', help="skip the db stage")
+    parser.add_argument('--cache', action='store_true', help="look up the results in the inference cache (redis)")
+    parser.add_argument('--schema', default='bilge_bench', help="scratch schema of the db stage (must not exist)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    messages = load_stream(args.input) if args.input else make_stream(args.posts, random.Random(args.seed))
+    if args.models == 'stub':
+        use_stub_analyzers()
+
+    scratch = None
+    if not args.no_db:
+        scratch = create_scratch_db(args.schema)
+        insert_posts(messages)
+    try:
+        report(*run(messages, args.batch_size, write=not args.no_db, use_cache=args.cache))
+    finally:
+        if scratch is not None:
+            drop_scratch_db(scratch, args.schema)
@@ -0,0 +1,56 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Micro-benchmark of the text preprocessor, run from the repo root : python -m benchmarks.bench_preprocess
+
+import random
+import timeit
+
+from bilge.sentiment.utils import ignore_list, modify_list, preprocess, preprocess_many
+
+words = ['bitcoin', 'market', 'the', 'government', 'announced', 'new', 'policy', 'today', 'price', 'drops',
+         'istanbul', 'ankara', 'election', 'results', 'breaking', 'of', 'and', 'is', 'a', 'for']
+specials = ['@elonmusk', '@user', 'https://t.co/xY12abC', 'http://example.com/news?id=1', 'www.example.com', '---']
+
+
+def legacy_preprocess(text):
+    # per-token implementation that bilge.sentiment.utils.preprocess replaced
+    new_text = []
+    for t in text.split(" "):
+        curr_t = None
+
+        for c, m in modify_list:
+            if t.startswith(c):
+                curr_t = m
+                break
+
+        for ig_text in ignore_list:
+            if t.startswith(ig_text):
+                curr_t = ''
+                break
+
+        new_text.append(t) if curr_t is None else new_text.append(curr_t)
+    return " ".join(new_text)
+
+
+def make_post(rng):
+    # mix of tweets, headlines and news bodies, roughly the shape of mergen's traffic
+    n_words = rng.choice([12, 25, 40, 300])
+    return " ".join(rng.choice(specials) if rng.random() < 0.08 else rng.choice(words) for _ in range(n_words))
+
+
+def bench(name, fn, corpus, repeat=5):
+    best = min(timeit.repeat(lambda: fn(corpus), number=1, repeat=repeat))
+    print(f"{name:<24} {best * 1e6 / len(corpus):8.2f} us/post")
+    return best
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    corpus = [make_post(rng) for _ in range(20000)]
+    assert [legacy_preprocess(t) for t in corpus] == preprocess_many(corpus)
+
+    before = bench("legacy (per token)", lambda c: [legacy_preprocess(t) for t in c], corpus)
+    bench("preprocess", lambda c: [preprocess(t) for t in c], corpus)
+    after = bench("preprocess_many", preprocess_many, corpus)
+    processed = preprocess_many(corpus)
+    bench("preprocess_many (again)", preprocess_many, processed)
+    print(f"speedup : {before / after:.1f}x")
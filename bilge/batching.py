@@ -0,0 +1,112 @@
+# (c) 2021 Emir Erbasan (humanova)
+
+import threading
+import time
+
+from bilge.logger import logging
+
+
+class PostAccumulator:
+    def __init__(self, flush, max_batch_size=64, max_latency=2.0,
+                 queue_depth=None, max_queue_depth=1000, max_buffered=5000, on_drop=None):
+        """
+            Buffers incoming posts per language and hands them to 'flush' (a list of posts)
+            once a group reaches 'max_batch_size' posts or its oldest post waited 'max_latency' seconds.
+            While 'queue_depth()' is over 'max_queue_depth', posts are held back,
+            dropping the oldest ones past 'max_buffered' (the backlog scanner picks them up later),
+            'on_drop' is called with the dropped posts
+        """
+        self.flush = flush
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max_queue_depth
+        self.max_buffered = max_buffered
+        self.on_drop = on_drop
+
+        self.groups = {}  # language -> (time of the oldest post, posts)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # stop the deadline thread and flush everything that is still buffered
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.flush_ready(drain=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.max_latency / 4):
+            self.flush_ready()
+
+    def add(self, posts):
+        with self.lock:
+            now = time.monotonic()
+            for p in posts:
+                self.groups.setdefault(p['language'], (now, []))[1].append(p)
+        self.flush_ready()
+        with self.lock:
+            self.drop_overflow()
+
+    def buffered(self):
+        with self.lock:
+            return self.count_buffered()
+
+    def count_buffered(self):
+        # called with the lock held
+        return sum(len(group) for _, group in self.groups.values())
+
+    def backpressured(self):
+        if self.queue_depth is None:
+            return False
+        try:
+            return self.queue_depth() > self.max_queue_depth
+        except Exception as e:
+            logging.warning(f'[Bilge:Batching] Could not get the queue depth : {e}')
+            return False
+
+    def drop_overflow(self):
+        # called with the lock held, drops the oldest posts of the oldest groups
+        overflow = self.count_buffered() - self.max_buffered
+        while overflow > 0:
+            language, (created, group) = min(self.groups.items(), key=lambda g: g[1][0])
+            dropped = group[:overflow]
+            del group[:overflow]
+            if not group:
+                del self.groups[language]
+            overflow -= len(dropped)
+            if self.on_drop is not None:
+                self.on_drop(dropped)
+            logging.warning(f'[Bilge:Batching] Buffer is full, dropped {len(dropped)} posts '
+                            f'(language : {language}), they will be picked up by the backlog scanner')
+
+    def flush_ready(self, drain=False):
+        if not drain and self.backpressured():
+            return
+
+        batches = []
+        with self.lock:
+            now = time.monotonic()
+            for language in list(self.groups):
+                created, group = self.groups[language]
+                while len(group) >= self.max_batch_size:
+                    batches.append(group[:self.max_batch_size])
+                    del group[:self.max_batch_size]
+                if group and (drain or now - created >= self.max_latency):
+                    batches.append(group[:])
+                    del group[:]
+                if not group:
+                    del self.groups[language]
+
+        for batch in batches:
+            try:
+                self.flush(batch)
+            except Exception as e:
+                logging.warning(f'[Bilge:Batching] Could not flush {len(batch)} posts : {e}')
@@ -0,0 +1,234 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Offline bulk analysis of post archives, without redis/celery in the loop
+#  python -m bilge.bulk posts.jsonl --output results/ --processes 4
+#  python -m bilge.bulk posts.parquet --db
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+
+from bilge import database, tasks
+from bilge.langid import get_identifier
+from bilge.logger import logging
+from bilge.main import Bilge
+
+OUTPUT_FILES = ('sentiment.jsonl', 'named_entity.jsonl', 'nlp_inapplicability.jsonl')
+
+
+def to_post(record):
+    # accepts mergen's post shape (the 'new_posts' messages) and bilge's post dicts
+    if 'ID' in record:
+        record = Bilge.redis_post_to_model_dict(record)
+    return {'id': record['id'], 'title': record.get('title') or '', 'text': record.get('text') or '',
+            'source': record.get('source') or '', 'language': record.get('language') or None}
+
+
+def read_jsonl(path):
+    # a line holds a post, or a list of posts
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            for record in (data if isinstance(data, list) else [data]):
+                yield to_post(record)
+
+
+def read_parquet(path, chunk_size):
+    import pyarrow.parquet
+    for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        # columns -> rows (RecordBatch.to_pylist needs pyarrow 7)
+        columns = batch.to_pydict()
+        for values in zip(*columns.values()):
+            yield to_post(dict(zip(columns, values)))
+
+
+def read_chunks(path, file_format, chunk_size, skip=0):
+    posts = read_parquet(path, chunk_size) if file_format == 'parquet' else read_jsonl(path)
+    posts = itertools.islice(posts, skip, None)
+    while True:
+        chunk = list(itertools.islice(posts, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def init_worker(threads):
+    if threads:
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+
+
+def analyze_chunk(posts, kinds, use_cache):
+    # runs in the pool processes, returns the results of the posts in the task's format
+    lid = get_identifier()
+    if lid is not None:
+        lid.identify(posts)
+
+    results = {}
+    if 'sentiment' in kinds:
+        results['sentiment'] = tasks.calculate_sentiments(posts, use_cache=use_cache)
+    if 'ner' in kinds:
+        results['ner'] = tasks.calculate_named_entities(posts, use_cache=use_cache)
+    return len(posts), results
+
+
+class FileWriter:
+    def __init__(self, directory):
+        """
+            Appends the results to jsonl files in 'directory', the files are cut back to their
+            checkpointed sizes on resume so that no result is written twice
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.paths = {name: os.path.join(directory, name) for name in OUTPUT_FILES}
+        self.files = {}
+
+    def open(self, sizes):
+        for name, path in self.paths.items():
+            self.files[name] = open(path, 'a+b')
+            self.files[name].truncate(sizes.get(name, 0))
+            self.files[name].seek(0, os.SEEK_END)
+
+    def write_lines(self, name, rows):
+        self.files[name].write(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in rows).encode('utf8'))
+
+    def write(self, results):
+        if 'sentiment' in results:
+            sentiments, inapplicable = results['sentiment']
+            self.write_lines('sentiment.jsonl', sentiments)
+            self.write_lines('nlp_inapplicability.jsonl', ({**p, 'kind': 'sentiment'} for p in inapplicable))
+        if 'ner' in results:
+            entities, _, inapplicable = results['ner']
+            self.write_lines('named_entity.jsonl', entities)
+            self.write_lines('nlp_inapplicability.jsonl', ({**p, 'kind': 'ner'} for p in inapplicable))
+
+    def flush(self):
+        # returns the file sizes to checkpoint
+        sizes = {}
+        for name, f in self.files.items():
+            f.flush()
+            os.fsync(f.fileno())
+            sizes[name] = f.tell()
+        return sizes
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+class DBWriter:
+    def __init__(self):
+        """
+            Writes the results to postgres like the workers do (upserts and replacements, so a
+            chunk written again on resume is harmless), with COPY for the inserts.
+            The posts must already be in the posts table
+        """
+        database.db.use_copy = True
+
+    def open(self, sizes):
+        pass
+
+    def write(self, results):
+        if 'sentiment' in results:
+            tasks.insert_sentiments(*results['sentiment'])
+        if 'ner' in results:
+            tasks.insert_named_entities(*results['ner'])
+
+    def flush(self):
+        return {}
+
+    def close(self):
+        database.release_connection()
+
+
+def load_checkpoint(path, input_path):
+    if not os.path.exists(path):
+        return {'input': input_path, 'done': 0, 'sizes': {}}
+    with open(path, encoding='utf8') as f:
+        checkpoint = json.load(f)
+    if checkpoint['input'] != input_path:
+        raise ValueError(f"the checkpoint {path} belongs to {checkpoint['input']}, pass --restart to start over")
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    # written to a temporary file first, so a crash never leaves a partial checkpoint
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+def run(args):
+    input_path = os.path.abspath(args.input)
+    file_format = args.format or ('parquet' if input_path.endswith('.parquet') else 'jsonl')
+    checkpoint_path = args.checkpoint or (os.path.join(args.output, 'checkpoint.json') if args.output else
+                                          input_path + '.checkpoint')
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = load_checkpoint(checkpoint_path, input_path)
+
+    writer = FileWriter(args.output) if args.output else DBWriter()
+    writer.open(checkpoint['sizes'])
+
+    # the models are loaded before the pool forks, the processes share their weights
+    for task_type, language in tasks.analyzer_factories:
+        if task_type in args.tasks:
+            tasks.get_analyzer(task_type, language)
+    get_identifier()
+
+    logging.info(f'[Bilge:Bulk] Analyzing {input_path} ({", ".join(args.tasks)}) with {args.processes} processes, '
+                 f'starting after {checkpoint["done"]} posts')
+    start = time.monotonic()
+    analyzed = 0
+
+    def write_result(result):
+        # results are written in input order, the checkpoint counts the posts written so far
+        nonlocal analyzed
+        count, results = result.get()
+        writer.write(results)
+        checkpoint['done'] += count
+        checkpoint['sizes'] = writer.flush()
+        save_checkpoint(checkpoint_path, checkpoint)
+
+        analyzed += count
+        logging.info(f'[Bilge:Bulk] {checkpoint["done"]} posts done '
+                     f'({analyzed / (time.monotonic() - start):.1f} posts/s)')
+
+    with multiprocessing.get_context('fork').Pool(args.processes, initializer=init_worker,
+                                                  initargs=(args.threads,)) as pool:
+        # at most 2 chunks per process in flight, the input isn't read ahead of the workers
+        pending = deque()
+        for chunk in read_chunks(input_path, file_format, args.chunk_size, skip=checkpoint['done']):
+            pending.append(pool.apply_async(analyze_chunk, (chunk, args.tasks, args.cache)))
+            if len(pending) >= 2 * args.processes:
+                write_result(pending.popleft())
+        while pending:
+            write_result(pending.popleft())
+
+    writer.close()
+    logging.info(f'[Bilge:Bulk] Done, analyzed {analyzed} posts in {time.monotonic() - start:.1f}s')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="analyze a jsonl/parquet post archive without the broker")
+    parser.add_argument('input', help="jsonl (a post or a list of posts per line) or parquet file")
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], help="by default from the file extension")
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--output', help="directory to write the results as jsonl files")
+    output.add_argument('--db', action='store_true', help="write the results to postgres (posts must exist)")
+    parser.add_argument('--tasks', nargs='+', choices=['sentiment', 'ner'], default=['sentiment', 'ner'])
+    parser.add_argument('--processes', type=int, default=max(1, os.cpu_count() // 2))
+    parser.add_argument('--threads', type=int, default=2, help="torch threads per process (0 : torch's default)")
+    parser.add_argument('--chunk-size', type=int, default=256, help="posts per inference call")
+    parser.add_argument('--checkpoint', help="checkpoint file (default : in the output directory, or next to "
+                                             "the input with --db)")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and start over")
+    parser.add_argument('--cache', action='store_true', help="use the redis inference cache")
+    run(parser.parse_args())
@@ -0,0 +1,139 @@
+# (c) 2021 Emir Erbasan (humanova)
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from bilge import metrics
+from bilge.logger import logging
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+class InferenceCache:
+    def __init__(self, model_id, redis_client=None, lru_size=10000, ttl=86400, max_entries=500000):
+        """
+            Two tier (in-process LRU + shared redis) cache of analysis results,
+            keyed by the model id and the hash of the preprocessed text
+        """
+        self.model_id = model_id
+        self.redis_client = redis_client
+        self.lru = LRUCache(lru_size)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.prefix = f'bilge:cache:{model_id}:'
+        self.index_key = f'bilge:cache:{model_id}'  # sorted set of keys by insertion time
+        self.stats_key = 'bilge:cache:stats'
+        self.counters = {'hits_lru': 0, 'hits_redis': 0, 'misses': 0}
+
+    def key(self, text):
+        return self.prefix + hashlib.sha1(text.encode('utf8')).hexdigest()
+
+    def get_or_compute(self, texts, compute):
+        """
+            Returns the results for the texts in order,
+            calls 'compute' (list of texts -> list of results) only for the unique uncached texts
+        """
+        keys = [self.key(t) for t in texts]
+        results = {}
+        for k in keys:
+            value = self.lru.get(k)
+            if value is not None:
+                results[k] = value
+        lru_hits = len(results)
+
+        missing = list(OrderedDict.fromkeys(k for k in keys if k not in results))
+        if missing and self.redis_client is not None:
+            try:
+                for k, value in zip(missing, self.redis_client.mget(missing)):
+                    if value is not None:
+                        results[k] = value.decode('utf8')
+                        self.lru.set(k, results[k])
+            except Exception as e:
+                logging.warning(f'[Bilge:Cache] Could not read from redis : {e}')
+        redis_hits = len(results) - lru_hits
+
+        missing = [k for k in missing if k not in results]
+        if missing:
+            text_of = dict(zip(keys, texts))
+            computed = {k: json.dumps(r) for k, r in zip(missing, compute([text_of[k] for k in missing]))}
+            for k, value in computed.items():
+                self.lru.set(k, value)
+            results.update(computed)
+            self.store(computed)
+
+        self.count(hits_lru=lru_hits, hits_redis=redis_hits, misses=len(missing))
+
+        # decode per text so that the callers get their own copies
+        return [json.loads(results[k]) for k in keys]
+
+    def store(self, values):
+        if self.redis_client is None:
+            return
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            now = time.time()
+            for k, value in values.items():
+                pipe.set(k, value, ex=self.ttl)
+            pipe.zadd(self.index_key, {k: now for k in values})
+            # evict expired keys from the index, then the oldest entries over the size limit
+            pipe.zremrangebyscore(self.index_key, 0, now - self.ttl)
+            pipe.zcard(self.index_key)
+            size = pipe.execute()[-1]
+
+            if size > self.max_entries:
+                evicted = [k for k, _ in self.redis_client.zpopmin(self.index_key, size - self.max_entries)]
+                if evicted:
+                    self.redis_client.delete(*evicted)
+        except Exception as e:
+            logging.warning(f'[Bilge:Cache] Could not write to redis : {e}')
+
+    def count(self, **counts):
+        for name, n in counts.items():
+            self.counters[name] += n
+            metrics.cache_lookups.inc(n, model=self.model_id, result=name)
+
+        if self.redis_client is None:
+            return
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for name, n in counts.items():
+                if n > 0:
+                    pipe.hincrby(self.stats_key, f'{self.model_id}:{name}', n)
+            pipe.execute()
+        except Exception as e:
+            logging.warning(f'[Bilge:Cache] Could not update the cache stats : {e}')
+
+    def stats(self):
+        lookups = sum(self.counters.values())
+        hits = self.counters['hits_lru'] + self.counters['hits_redis']
+        return {**self.counters, 'hit_rate': hits / lookups if lookups > 0 else 0.0}
+
+
+def get_shared_stats(redis_client):
+    # hit/miss counters of every worker, as {model_id: {counter: value}}
+    stats = {}
+    for field, value in redis_client.hgetall('bilge:cache:stats').items():
+        model_id, name = field.decode('utf8').rsplit(':', 1)
+        stats.setdefault(model_id, {})[name] = int(value)
+    return stats
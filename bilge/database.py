@@ -1,22 +1,63 @@
 # (c) 2021 Emir Erbasan (humanova)
 
+import io
+import threading
+from collections import namedtuple
 from datetime import datetime, timedelta
 
 from psycopg2 import *
+from psycopg2.extensions import TransactionRollbackError
 from peewee import *
-from playhouse.shortcuts import model_to_dict
+from peewee import EXCLUDED, InterfaceError, OperationalError, chunked
+from playhouse.pool import PooledPostgresqlDatabase
+from playhouse.shortcuts import ReconnectMixin, model_to_dict
 
 import bilge
+from bilge import metrics
+from bilge.cache import LRUCache
 from bilge.logger import logging
 
 config = bilge.config
 
-db = None  # BilgeDB instance
-bilge_db = PostgresqlDatabase(config.db_name,
-                              user=config.db_user,
-                              password=config.db_password,
-                              host=config.db_host,
-                              port=config.db_port)
+
+class PostgresReconnectMixin(ReconnectMixin):
+    # reconnects and retries a query (outside of transactions) when the connection was dropped,
+    # peewee's ReconnectMixin only lists mysql's errors
+    reconnect_errors = (
+        (OperationalError, 'terminat'),  # terminated by the server (restart, pg_terminate_backend)
+        (OperationalError, 'server closed the connection'),
+        (OperationalError, 'connection has been closed unexpectedly'),  # ssl
+        (OperationalError, 'could not receive data from server'),
+        (InterfaceError, 'connection already closed'),
+    )
+
+
+class ReconnectingPostgresqlDatabase(PostgresReconnectMixin, PostgresqlDatabase):
+    pass
+
+
+class ReconnectingPooledPostgresqlDatabase(PostgresReconnectMixin, PooledPostgresqlDatabase):
+    pass
+
+
+def create_database():
+    # connections are opened on first use (peewee's autoconnect), not at import
+    options = {'user': config.db_user, 'password': config.db_password, 'host': config.db_host,
+               'port': config.db_port}
+    reconnect = getattr(config, 'db_reconnect', True)
+    if getattr(config, 'db_pool', True):
+        # connections idle for more than 'db_stale_timeout' seconds are recycled,
+        # a thread waits up to 'db_pool_timeout' seconds for a free connection
+        options.update(max_connections=getattr(config, 'db_max_connections', 8),
+                       stale_timeout=getattr(config, 'db_stale_timeout', 300),
+                       timeout=getattr(config, 'db_pool_timeout', 10))
+        database_class = ReconnectingPooledPostgresqlDatabase if reconnect else PooledPostgresqlDatabase
+    else:
+        database_class = ReconnectingPostgresqlDatabase if reconnect else PostgresqlDatabase
+    return database_class(config.db_name, **options)
+
+
+bilge_db = create_database()
 
 
 class Posts(Model):
@@ -42,15 +83,25 @@ class Sentiment(Model):
     positive = DoubleField()
     neutral = DoubleField(null=True)
     negative = DoubleField()
+    model = CharField(null=True)  # id/version of the model that produced the result
 
     class Meta:
         database = bilge_db
         db_table = 'sentiment'
 
+class EntityName(Model):
+    name = CharField(unique=True)  # normalized entity text (see normalize_entity)
+
+    class Meta:
+        database = bilge_db
+        db_table = 'entity'
+
 class NamedEntity(Model):
     post_id = ForeignKeyField(Posts, backref='entity')  # not unique since a post may have multiple named entities
-    entity = CharField()
+    entity = CharField(null=True)  # legacy rows only, new rows reference the interned name
+    entity_id = ForeignKeyField(EntityName, null=True)
     label = CharField()
+    model = CharField(null=True)  # id/version of the model that produced the result
 
     class Meta:
         database = bilge_db
@@ -64,11 +115,152 @@ class NLPInapplicability(Model):
         db_table = 'nlp_inapplicability'
 
 
+# daily rollups for the dashboards, updated in the same transaction as the results (see BilgeDB)
+class SentimentDaily(Model):
+    day = DateField()
+    source = CharField()
+    language = CharField()
+    posts = IntegerField(default=0)
+    positive_sum = DoubleField(default=0)
+    negative_sum = DoubleField(default=0)
+    neutral_sum = DoubleField(default=0)
+    neutral_posts = IntegerField(default=0)  # posts with a neutral score (the turkish model has none)
+
+    class Meta:
+        database = bilge_db
+        db_table = 'sentiment_daily'
+        primary_key = CompositeKey('day', 'source', 'language')
+
+class EntityDaily(Model):
+    day = DateField()
+    source = CharField()
+    entity_id = ForeignKeyField(EntityName)
+    label = CharField()
+    mentions = IntegerField(default=0)
+
+    class Meta:
+        database = bilge_db
+        db_table = 'entity_daily'
+        primary_key = CompositeKey('day', 'source', 'entity_id', 'label')
+
+
+# languages identified by bilge.langid, the posts table (and its language column) is mergen's
+class PostLanguage(Model):
+    post_id = ForeignKeyField(Posts, backref='identified_language', unique=True)
+    language = CharField()
+
+    class Meta:
+        database = bilge_db
+        db_table = 'post_language'
+
+
+class BacklogScanState(Model):
+    name = CharField(unique=True)
+    last_post_id = IntegerField(default=0)  # high-water mark of the keyset scan
+
+    class Meta:
+        database = bilge_db
+        db_table = 'backlog_scan_state'
+
+
+# columns added after the tables were first created, applied before the models' tables and indexes
+# are created (the indexes of an existing table need its new columns)
+migration_statements = [
+    'ALTER TABLE IF EXISTS sentiment ADD COLUMN IF NOT EXISTS model VARCHAR(255)',
+    'ALTER TABLE IF EXISTS named_entity ADD COLUMN IF NOT EXISTS model VARCHAR(255)',
+    'ALTER TABLE IF EXISTS named_entity ADD COLUMN IF NOT EXISTS entity_id INTEGER REFERENCES entity (id)',
+    'ALTER TABLE IF EXISTS named_entity ALTER COLUMN entity DROP NOT NULL',
+]
+
+# supporting indexes for the backlog scans ('posts' table is owned by mergen) and views
+schema_statements = [
+    'CREATE INDEX IF NOT EXISTS posts_created_at_idx ON posts (created_at)',
+    'CREATE INDEX IF NOT EXISTS posts_language_id_idx ON posts (language, id)',
+    'CREATE INDEX IF NOT EXISTS named_entity_post_id_idx ON named_entity (post_id)',
+    'CREATE INDEX IF NOT EXISTS named_entity_entity_id_idx ON named_entity (entity_id)',
+    # named entities with their text, for the dashboards (legacy rows keep the text in named_entity)
+    'CREATE OR REPLACE VIEW named_entity_text AS '
+    'SELECT ne.id, ne.post_id, coalesce(e.name, ne.entity) AS entity, ne.label, ne.model '
+    'FROM named_entity ne LEFT JOIN entity e ON e.id = ne.entity_id',
+]
+
+# the current totals of the posts (= ANY(%s)) per rollup key, see BilgeDB.update_rollup
+SENTIMENT_TOTALS_SQL = (
+    "SELECT p.created_at::date, coalesce(p.source, ''), coalesce(pl.language, p.language, ''), count(*), "
+    "sum(s.positive), sum(s.negative), coalesce(sum(s.neutral), 0), count(s.neutral) "
+    "FROM sentiment s JOIN posts p ON p.id = s.post_id LEFT JOIN post_language pl ON pl.post_id = p.id "
+    "WHERE {where} GROUP BY 1, 2, 3")
+ENTITY_TOTALS_SQL = (
+    "SELECT p.created_at::date, coalesce(p.source, ''), ne.entity_id, ne.label, count(*) "
+    "FROM named_entity ne JOIN posts p ON p.id = ne.post_id WHERE ne.entity_id IS NOT NULL AND {where} "
+    "GROUP BY 1, 2, 3, 4")
+
+# lock : advisory lock class, the updates of a post's results are serialized on (lock, post id)
+Rollup = namedtuple('Rollup', ['table', 'keys', 'values', 'totals_sql', 'lock'])
+SENTIMENT_ROLLUP = Rollup(SentimentDaily, ('day', 'source', 'language'),
+                          ('posts', 'positive_sum', 'negative_sum', 'neutral_sum', 'neutral_posts'),
+                          SENTIMENT_TOTALS_SQL, 1)
+ENTITY_ROLLUP = Rollup(EntityDaily, ('day', 'source', 'entity_id', 'label'), ('mentions',), ENTITY_TOTALS_SQL, 2)
+
+
+class RetryableError(Exception):
+    # a write that lost a deadlock or a serialization conflict, rolled back as a whole : the task is retried
+    pass
+
+
+def is_retryable(e):
+    # peewee re-raises psycopg2's errors as its own, the original is the context
+    return isinstance(e, TransactionRollbackError) or isinstance(e.__context__, TransactionRollbackError)
+
+
+ENTITY_STRIP_CHARS = ' \'"`“”‘’,;:!?()[]{}<>*#'
+
+
+def post_language():
+    # the language identified by bilge.langid, else mergen's (the queries left join post_language)
+    return fn.COALESCE(PostLanguage.language, Posts.language)
+
+
+def language_filter(languages=None, include_unknown=False):
+    # posts in one of 'languages' (any language if None),
+    # 'include_unknown' also matches the posts without a language (to be identified by bilge.langid)
+    language = post_language()
+    condition = (language.is_null(False)) & (language != '')
+    if languages is not None:
+        condition = language.in_(list(languages))
+    if include_unknown:
+        condition = condition | language.is_null() | (language == '')
+    return condition
+
+
+def normalize_entity(text):
+    # collapse the whitespace, drop the surrounding quotes/punctuation and the possessive suffix
+    text = ' '.join(text.split()).strip(ENTITY_STRIP_CHARS)
+    if text.endswith(("'s", "’s")):
+        text = text[:-2].strip(ENTITY_STRIP_CHARS)
+    return text[:255]
+
+
+def copy_row(values):
+    # format a row for postgres' COPY text format
+    fields = []
+    for v in values:
+        if v is None:
+            fields.append('\\N')
+        else:
+            fields.append(str(v).replace('\\', '\\\\').replace('\t', '\\t')
+                          .replace('\n', '\\n').replace('\r', '\\r'))
+    return '\t'.join(fields) + '\n'
+
+
 class BilgeDB:
     def __init__(self):
+        self.insert_chunk_size = getattr(config, 'db_insert_chunk_size', 1000)
+        self.use_copy = getattr(config, 'db_use_copy', False)
+        self.entity_ids = LRUCache(getattr(config, 'db_entity_cache_size', 100000))  # entity name -> id
         try:
             self.db = bilge_db
-            self.db.connect()
+            self.db.connect(reuse_if_open=True)
             self.init_tables()
 
         except Exception as e:
@@ -76,117 +268,410 @@ class BilgeDB:
             raise e
 
     def init_tables(self):
+        # entity first (the named_entity migration references it), then the new columns of the existing
+        # tables, then each model's table and indexes on its own so that one failure doesn't skip the others
+        self.create_table(EntityName)
+        self.execute_schema(migration_statements)
+        for model in [Sentiment, NamedEntity, NLPInapplicability, SentimentDaily, EntityDaily, BacklogScanState,
+                      PostLanguage]:
+            self.create_table(model)
+        self.execute_schema(schema_statements)
+
+    def create_table(self, model):
         try:
-            self.db.create_tables([Sentiment, NamedEntity, NLPInapplicability])
+            model.create_table(safe=True)
         except Exception as e:
-            logging.warning("[DB] Couldn't create tables (or tables already exist).")
-            logging.warning(e)
+            logging.warning(f"[DB] Couldn't create the {model._meta.table_name} table : {e}")
+
+    def execute_schema(self, statements):
+        for statement in statements:
+            try:
+                self.db.execute_sql(statement)
+            except Exception as e:
+                logging.warning(f"[DB] Couldn't update the schema ({statement}) : {e}")
+
+    # -- rollups --
+    def rollup_totals(self, rollup, post_ids):
+        """
+            Takes the posts' advisory locks and returns their current totals, {rollup key : [values]}
+            must be called inside the transaction that changes the posts' results, before the change,
+            so concurrent writes of the same post wait and read the committed results
+        """
+        post_ids = sorted(post_ids)
+        for batch in chunked(post_ids, self.insert_chunk_size):
+            self.db.execute_sql("SELECT pg_advisory_xact_lock(%s, id) FROM unnest(%s::int[]) AS id",
+                                (rollup.lock, list(batch)))
+        return self.read_rollup_totals(rollup, post_ids)
+
+    def read_rollup_totals(self, rollup, post_ids):
+        totals = {}
+        n_keys = len(rollup.keys)
+        for batch in chunked(post_ids, self.insert_chunk_size):
+            cursor = self.db.execute_sql(rollup.totals_sql.format(where='p.id = ANY(%s)'), (list(batch),))
+            for row in cursor.fetchall():
+                key, values = tuple(row[:n_keys]), row[n_keys:]
+                current = totals.get(key)
+                totals[key] = list(values) if current is None else [a + b for a, b in zip(current, values)]
+        return totals
+
+    def update_rollup(self, rollup, post_ids, old_totals):
+        """
+            Applies the change of the posts' results since 'rollup_totals' (old_totals) to the rollup,
+            one signed delta per key, upserted in key order so concurrent workers lock the rows in the same order
+        """
+        new_totals = self.read_rollup_totals(rollup, sorted(post_ids))
+        rows = []
+        for key in sorted(old_totals.keys() | new_totals.keys()):
+            old = old_totals.get(key, [0] * len(rollup.values))
+            new = new_totals.get(key, [0] * len(rollup.values))
+            delta = [b - a for a, b in zip(old, new)]
+            if any(delta):
+                rows.append(dict(zip(rollup.keys + rollup.values, key + tuple(delta))))
+
+        table = rollup.table
+        update = {getattr(table, f): getattr(table, f) + getattr(EXCLUDED, f) for f in rollup.values}
+        for batch in chunked(rows, self.insert_chunk_size):
+            (table
+             .insert_many(batch)
+             .on_conflict(conflict_target=[getattr(table, f) for f in rollup.keys], update=update)
+             .execute())
+
+    def rebuild_rollups(self, since=None):
+        """
+            Recomputes the rollups from the results (of the posts created at/after 'since'), a day per transaction :
+            the day's rollup rows are replaced under a short table lock, the workers' updates wait for that day only
+        """
+        # the days of the posts and of the current rollup rows (those of deleted posts are cleared too)
+        days = []
+        for field in (Posts.created_at, SentimentDaily.day, EntityDaily.day):
+            query = field.model.select(fn.MIN(field).cast('date'), fn.MAX(field).cast('date'))
+            if since is not None:
+                query = query.where(field >= since)
+            days += [d for d in query.scalar(as_tuple=True) if d is not None]
+        if not days:
+            return
+
+        day, last = min(days), max(days)
+        while day <= last:
+            start = datetime.combine(day, datetime.min.time())
+            for rollup in (SENTIMENT_ROLLUP, ENTITY_ROLLUP):
+                self.rebuild_rollup_day(rollup, day, start, start + timedelta(days=1))
+            day += timedelta(days=1)
+
+    def rebuild_rollup_day(self, rollup, day, start, end):
+        table = rollup.table
+        with self.db.atomic():
+            self.db.execute_sql(f"LOCK TABLE {table._meta.table_name} IN EXCLUSIVE MODE")
+            table.delete().where(table.day == day).execute()
+            cursor = self.db.execute_sql(rollup.totals_sql.format(where='p.created_at >= %s AND p.created_at < %s'),
+                                         (start, end))
+            rows = [dict(zip(rollup.keys + rollup.values, row)) for row in cursor.fetchall()]
+            for batch in chunked(rows, self.insert_chunk_size):
+                table.insert_many(batch).execute()
 
     # -- sentiment --
     def add_post_sentiment(self, sentiment):
-        try:
-            with self.db.atomic():
-                (Sentiment
-                 .insert(**sentiment)
-                 .on_conflict(
-                    conflict_target=[Sentiment.post_id],
-                    preserve=[Sentiment.post_id],
-                    update={Sentiment.positive: sentiment['positive'],
-                            Sentiment.neutral: sentiment['neutral'],
-                            Sentiment.negative: sentiment['negative']})
-                 .execute())
-        except Exception as e:
-            logging.warning(f"[DB] Couldn't insert post : {e}")
+        self.add_post_sentiments([sentiment])
 
     def add_post_sentiments(self, sentiments):
+        # a multi-row upsert can't touch the same row twice, keep the last sentiment of each post
+        sentiments = list({s['post_id']: s for s in sentiments}.values())
         try:
-            with self.db.atomic():
-                for s in sentiments:
-                    (Sentiment
-                     .insert(**s)
-                     .on_conflict(
-                        conflict_target=[Sentiment.post_id],
-                        preserve=[Sentiment.post_id],
-                        update={Sentiment.positive: s['positive'],
-                                Sentiment.neutral: s['neutral'],
-                                Sentiment.negative: s['negative']})
-                     .execute())
+            with metrics.db_write_seconds.time(operation='sentiment'), self.db.atomic():
+                post_ids = [s['post_id'] for s in sentiments]
+                totals = self.rollup_totals(SENTIMENT_ROLLUP, post_ids)
+                if self.use_copy:
+                    self.copy_post_sentiments(sentiments)
+                else:
+                    for batch in chunked(sentiments, self.insert_chunk_size):
+                        (Sentiment
+                         .insert_many(batch)
+                         .on_conflict(
+                            conflict_target=[Sentiment.post_id],
+                            preserve=[Sentiment.post_id],
+                            update={Sentiment.positive: EXCLUDED.positive,
+                                    Sentiment.neutral: EXCLUDED.neutral,
+                                    Sentiment.negative: EXCLUDED.negative,
+                                    Sentiment.model: EXCLUDED.model})
+                         .execute())
+                self.update_rollup(SENTIMENT_ROLLUP, post_ids, totals)
         except Exception as e:
+            if is_retryable(e):
+                raise RetryableError(f"Couldn't insert sentiments : {e}") from e
             logging.warning(f"[DB] Couldn't insert sentiments : {e}")
-            logging.warning(f"sentiment data : {sentiments}")
+            logging.warning(f"sentiment post ids : {[s['post_id'] for s in sentiments]}")
+
+    def copy_post_sentiments(self, sentiments):
+        # COPY into a staging table, then merge into the sentiment table with a single upsert
+        # must be called inside a transaction, the staging table is dropped on commit
+        # (and emptied first when an earlier call of the same transaction created it)
+        table = Sentiment._meta.table_name
+        data = io.StringIO(''.join(copy_row((s['post_id'], s['positive'], s['neutral'], s['negative'],
+                                             s.get('model'))) for s in sentiments))
+        cursor = self.db.cursor()
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS sentiment_staging "
+                       "(post_id integer, positive double precision, neutral double precision, "
+                       "negative double precision, model varchar(255)) ON COMMIT DROP")
+        cursor.execute("TRUNCATE sentiment_staging")
+        cursor.copy_expert("COPY sentiment_staging (post_id, positive, neutral, negative, model) FROM STDIN", data)
+        cursor.execute(f"INSERT INTO {table} (post_id, positive, neutral, negative, model) "
+                       f"SELECT post_id, positive, neutral, negative, model FROM sentiment_staging "
+                       f"ON CONFLICT (post_id) DO UPDATE SET positive = EXCLUDED.positive, "
+                       f"neutral = EXCLUDED.neutral, negative = EXCLUDED.negative, model = EXCLUDED.model")
 
     def delete_post_sentiments(self, post_ids):
         try:
             # posts = NLPInapplicability.select().join().where(NLPInapplicability.post_id << post_ids)
             with self.db.atomic():
+                totals = self.rollup_totals(SENTIMENT_ROLLUP, post_ids)
                 Sentiment.delete().where(Sentiment.post_id.in_(post_ids)).execute()
+                self.update_rollup(SENTIMENT_ROLLUP, post_ids, totals)
         except Exception as e:
+            if is_retryable(e):
+                raise RetryableError(f"Couldn't delete sentiments : {e}") from e
             logging.warning(f"[DB] Couldn't delete sentiments : {e}")
             logging.warning(f"post ids : {post_ids}")
 
     # -- named entity --
+    def intern_entities(self, names):
+        # returns {name : entity id}, adding the new names to the entity table
+        # (outside of the callers' transaction, so the cached ids are always committed)
+        ids = {}
+        missing = []
+        for name in set(names):
+            entity_id = self.entity_ids.get(name)
+            if entity_id is None:
+                missing.append(name)
+            else:
+                ids[name] = entity_id
+
+        # sorted, so that concurrent inserts of the same names don't deadlock
+        for batch in chunked(sorted(missing), self.insert_chunk_size):
+            EntityName.insert_many([{'name': name} for name in batch]).on_conflict_ignore().execute()
+            for entity in EntityName.select(EntityName.id, EntityName.name).where(EntityName.name.in_(batch)):
+                ids[entity.name] = entity.id
+                self.entity_ids.set(entity.name, entity.id)
+        return ids
+
     def add_post_named_entity(self, named_entity):
-        try:
-            with self.db.atomic():
-                NamedEntity.insert(**named_entity).execute()
-        except Exception as e:
-            logging.warning(f"[DB] Couldn't insert named entity : {e}")
+        # replaces the post's named entities with this one
+        self.add_post_named_entities([named_entity])
 
-    def add_post_named_entities(self, named_entities):
+    def add_post_named_entities(self, named_entities, post_ids=None):
+        # replaces the named entities of the posts ('post_ids', or the posts in 'named_entities')
+        # in a single transaction, so readers never see a post without its entities
+        post_ids = sorted({e['post_id'] for e in named_entities}) if post_ids is None else sorted(post_ids)
         try:
-            with self.db.atomic():
-                for e in named_entities:
-                    NamedEntity.insert(**e).execute()
+            # entity texts are stored once in the entity table, the rows reference them
+            rows = []
+            for e in named_entities:
+                name = normalize_entity(e['entity'])
+                if name:
+                    rows.append({'post_id': e['post_id'], 'entity': name, 'label': e['label'],
+                                 'model': e.get('model')})
+            entity_ids = self.intern_entities([r['entity'] for r in rows])
+            for r in rows:
+                r['entity_id'] = entity_ids[r.pop('entity')]
+
+            with metrics.db_write_seconds.time(operation='named_entity'), self.db.atomic():
+                totals = self.rollup_totals(ENTITY_ROLLUP, post_ids)
+                for batch in chunked(post_ids, self.insert_chunk_size):
+                    NamedEntity.delete().where(NamedEntity.post_id.in_(batch)).execute()
+
+                if self.use_copy:
+                    self.copy_post_named_entities(rows)
+                else:
+                    for batch in chunked(rows, self.insert_chunk_size):
+                        NamedEntity.insert_many(batch).execute()
+                self.update_rollup(ENTITY_ROLLUP, post_ids, totals)
         except Exception as e:
+            if is_retryable(e):
+                raise RetryableError(f"Couldn't insert named entities : {e}") from e
             logging.warning(f"[DB] Couldn't insert named entities : {e}")
-            logging.warning(f"named entity data : {named_entities}")
+            logging.warning(f"named entity post ids : {post_ids}")
+
+    def copy_post_named_entities(self, named_entities):
+        # named entities have no conflict target, COPY straight into the table
+        table = NamedEntity._meta.table_name
+        data = io.StringIO(''.join(copy_row((e['post_id'], e['entity_id'], e['label'], e.get('model')))
+                                   for e in named_entities))
+        self.db.cursor().copy_expert(f"COPY {table} (post_id, entity_id, label, model) FROM STDIN", data)
+
+    def intern_legacy_entities(self, after_id=0, limit=10000):
+        # moves the texts of the rows inserted before the entity table into it, in named_entity.id order
+        # returns the last row id, None when there are no rows left
+        rows = list(NamedEntity
+                    .select(NamedEntity.id, NamedEntity.entity)
+                    .where((NamedEntity.id > after_id)
+                           & (NamedEntity.entity_id.is_null())
+                           & (NamedEntity.entity.is_null(False)))
+                    .order_by(NamedEntity.id)
+                    .limit(limit)
+                    .tuples())
+        if not rows:
+            return None
+
+        names = {row_id: normalize_entity(entity) for row_id, entity in rows}
+        entity_ids = self.intern_entities([name for name in names.values() if name])
+        updates = [(row_id, entity_ids[name]) for row_id, name in names.items() if name]
+        with metrics.db_write_seconds.time(operation='named_entity'), self.db.atomic():
+            self.db.execute_sql(f"UPDATE {NamedEntity._meta.table_name} SET entity_id = v.entity_id, entity = NULL "
+                                f"FROM unnest(%s::int[], %s::int[]) AS v (id, entity_id) "
+                                f"WHERE {NamedEntity._meta.table_name}.id = v.id",
+                                ([u[0] for u in updates], [u[1] for u in updates]))
+        return rows[-1][0]
 
     def delete_post_named_entities(self, post_ids):
         try:
             with self.db.atomic():
+                totals = self.rollup_totals(ENTITY_ROLLUP, post_ids)
                 NamedEntity.delete().where(NamedEntity.post_id.in_(post_ids)).execute()
+                self.update_rollup(ENTITY_ROLLUP, post_ids, totals)
         except Exception as e:
+            if is_retryable(e):
+                raise RetryableError(f"Couldn't delete named entities : {e}") from e
             logging.warning(f"[DB] Couldn't delete named entities : {e}")
             logging.warning(f"post ids : {post_ids}")
 
-    def get_posts_without_sentiment(self, limit: int, before_date=None):
+    def get_posts_without_sentiment(self, limit: int, before_date=None, after_id=0, languages=None,
+                                    include_unknown=False, until_id=None):
+        # keyset pagination over posts.id, pass the last seen post id as 'after_id' (and 'until_id' to stop at a post)
         before_date = datetime.utcnow() - timedelta(hours=1) if before_date is None else before_date
         try:
             posts = (Posts
-                     .select(Posts.id, Posts.source, Posts.title, Posts.text, Posts.language)
-                     .join_from(Posts, Sentiment, JOIN.LEFT_OUTER)
-                     .join_from(Posts, NLPInapplicability, JOIN.LEFT_OUTER)
-                     .where((Posts.created_at < before_date)
-                            & (Posts.language.is_null(False))
-                            & (Posts.language != '')
-                            & (Sentiment.id.is_null())
-                            & (NLPInapplicability.id.is_null()))
+                     .select(Posts.id, Posts.source, Posts.title, Posts.text, post_language().alias('language'))
+                     .join(PostLanguage, JOIN.LEFT_OUTER, on=(PostLanguage.post_id == Posts.id))
+                     .where((Posts.id > after_id)
+                            & ((Posts.id <= until_id) if until_id is not None else SQL('TRUE'))
+                            & (Posts.created_at < before_date)
+                            & language_filter(languages, include_unknown)
+                            & ~fn.EXISTS(Sentiment.select(SQL('1')).where(Sentiment.post_id == Posts.id))
+                            & ~fn.EXISTS(NLPInapplicability.select(SQL('1'))
+                                         .where(NLPInapplicability.post_id == Posts.id)))
+                     .order_by(Posts.id)
                      .limit(limit)
                      )
             return posts
         except Exception as e:
             logging.warning(f"[DB] Couldn't query the posts without sentiment : {e}")
 
-    def get_posts_without_named_entity(self, limit: int, before_date=None):
+    def get_posts_without_named_entity(self, limit: int, before_date=None, after_id=0, languages=('en',),
+                                       include_unknown=False, until_id=None):
+        # keyset pagination over posts.id, pass the last seen post id as 'after_id' (and 'until_id' to stop at a post)
         before_date = datetime.utcnow() - timedelta(hours=1) if before_date is None else before_date
         try:
             posts = (Posts
-                     .select(Posts.id, Posts.source, Posts.title, Posts.text, Posts.language)
-                     .join_from(Posts, NamedEntity, JOIN.LEFT_OUTER)
-                     .join_from(Posts, NLPInapplicability, JOIN.LEFT_OUTER)
-                     .where((Posts.created_at < before_date)
-                            & (Posts.language == 'en') # temporary (until the TR NER analyzer)
-                            & (Posts.language.is_null(False))
-                            # & (Posts.language != '') commented out until i implement the turkish ner analyzer
-                            & (NamedEntity.id.is_null())
-                            & (NLPInapplicability.id.is_null()))
+                     .select(Posts.id, Posts.source, Posts.title, Posts.text, post_language().alias('language'))
+                     .join(PostLanguage, JOIN.LEFT_OUTER, on=(PostLanguage.post_id == Posts.id))
+                     .where((Posts.id > after_id)
+                            & ((Posts.id <= until_id) if until_id is not None else SQL('TRUE'))
+                            & (Posts.created_at < before_date)
+                            & language_filter(languages, include_unknown)
+                            & ~fn.EXISTS(NamedEntity.select(SQL('1')).where(NamedEntity.post_id == Posts.id))
+                            & ~fn.EXISTS(NLPInapplicability.select(SQL('1'))
+                                         .where(NLPInapplicability.post_id == Posts.id)))
+                     .order_by(Posts.id)
                      .limit(limit)
                      )
             return posts
         except Exception as e:
             logging.warning(f"[DB] Couldn't query the posts without named entities : {e}")
 
+    def get_posts_for_reanalysis(self, kind, model, limit: int, after_id=0, languages=None):
+        # posts without a 'kind' ('sentiment' or 'named_entity') result from 'model', in keyset order
+        result = Sentiment if kind == 'sentiment' else NamedEntity
+        try:
+            posts = (Posts
+                     .select(Posts.id, Posts.source, Posts.title, Posts.text, post_language().alias('language'))
+                     .join(PostLanguage, JOIN.LEFT_OUTER, on=(PostLanguage.post_id == Posts.id))
+                     .where((Posts.id > after_id)
+                            & language_filter(languages)
+                            & ~fn.EXISTS(result.select(SQL('1'))
+                                         .where((result.post_id == Posts.id) & (result.model == model)))
+                            & ~fn.EXISTS(NLPInapplicability.select(SQL('1'))
+                                         .where(NLPInapplicability.post_id == Posts.id)))
+                     .order_by(Posts.id)
+                     .limit(limit)
+                     )
+            return posts
+        except Exception as e:
+            logging.warning(f"[DB] Couldn't query the posts for reanalysis : {e}")
+
+    def get_posts_by_ids(self, post_ids):
+        # the posts' analysis fields as dicts in the order of 'post_ids', for the id-only task payloads
+        # (deleted posts are left out). Errors aren't caught here, the task fails instead of skipping its posts
+        rows = (Posts
+                .select(Posts.id, Posts.source, post_language().alias('language'), Posts.title, Posts.text)
+                .join(PostLanguage, JOIN.LEFT_OUTER, on=(PostLanguage.post_id == Posts.id))
+                .where(Posts.id.in_(post_ids))
+                .dicts())
+        posts = {row['id']: row for row in rows}
+        return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+    def stream_posts(self, query, itersize=500):
+        # iterate over the query with a server-side cursor, yielding plain dicts
+        # instead of materializing model instances
+        sql, params = query.sql()
+        with self.db.atomic():
+            cursor = self.db.connection().cursor(name='bilge_post_stream')
+            cursor.itersize = itersize
+            try:
+                cursor.execute(sql, params)
+                columns = None
+                for row in cursor:
+                    if columns is None:
+                        columns = [c[0] for c in cursor.description]
+                    yield dict(zip(columns, row))
+            finally:
+                cursor.close()
+
+    def get_last_post_id(self, before_date):
+        return (Posts
+                .select(fn.MAX(Posts.id))
+                .where(Posts.created_at < before_date)
+                .scalar()) or 0
+
+    # -- backlog scan state --
+    def get_scan_position(self, name, default=0):
+        try:
+            return BacklogScanState.get(BacklogScanState.name == name).last_post_id
+        except BacklogScanState.DoesNotExist:
+            return default
+
+    def set_scan_position(self, name, last_post_id):
+        try:
+            with self.db.atomic():
+                (BacklogScanState
+                 .insert(name=name, last_post_id=last_post_id)
+                 .on_conflict(
+                    conflict_target=[BacklogScanState.name],
+                    update={BacklogScanState.last_post_id: EXCLUDED.last_post_id})
+                 .execute())
+        except Exception as e:
+            logging.warning(f"[DB] Couldn't update the scan position of '{name}' : {e}")
+
     # -- nlp_inapplicability --
+    def update_post_languages(self, languages):
+        # languages : {post id : language}, stored in post_language (mergen's posts keep their language).
+        # errors are raised, the caller doesn't send the posts with languages the db doesn't have
+        rows = [{'post_id': post_id, 'language': language} for post_id, language in sorted(languages.items())]
+        try:
+            with metrics.db_write_seconds.time(operation='language'), self.db.atomic():
+                # the sentiment rollups are per language, move the posts' results along
+                totals = self.rollup_totals(SENTIMENT_ROLLUP, languages)
+                for batch in chunked(rows, self.insert_chunk_size):
+                    (PostLanguage
+                     .insert_many(batch)
+                     .on_conflict(conflict_target=[PostLanguage.post_id],
+                                  update={PostLanguage.language: EXCLUDED.language})
+                     .execute())
+                self.update_rollup(SENTIMENT_ROLLUP, languages, totals)
+        except Exception as e:
+            logging.warning(f"[DB] Couldn't update the post languages : {e}")
+            if is_retryable(e):
+                raise RetryableError(f"Couldn't update the post languages : {e}") from e
+            raise
+
     def add_post_nlpinapplicability(self, post_id):
         try:
             with self.db.atomic():
@@ -198,11 +683,11 @@ class BilgeDB:
 
     def add_post_nlpinapplicabilities(self, posts):
         try:
-            with self.db.atomic():
+            with metrics.db_write_seconds.time(operation='nlp_inapplicability'), self.db.atomic():
                 NLPInapplicability.insert_many(posts).on_conflict_ignore().execute()
         except Exception as e:
             logging.warning(f"[DB] Couldn't insert inapplicable post ids : {e}")
-            logging.warning(f"posts data : {posts}")
+            logging.warning(f"post ids : {[p['post_id'] for p in posts]}")
 
     def delete_post_nlpinapplicabilities(self, post_ids):
         try:
@@ -218,4 +703,21 @@ def post_to_dict(post):
     return model_to_dict(post)
 
 
-db = BilgeDB()
+def release_connection():
+    # return the thread's connection to the pool (no-op without 'db_pool'), the next query takes one again
+    if isinstance(bilge_db, PooledPostgresqlDatabase) and not bilge_db.is_closed():
+        bilge_db.close()
+
+
+db_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # 'db' (the BilgeDB instance) is created on first access, importing the module doesn't connect
+    global db
+    if name == 'db':
+        with db_lock:
+            if 'db' not in globals():
+                db = BilgeDB()
+        return db
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
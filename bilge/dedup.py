@@ -0,0 +1,108 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Near-duplicate index : reuses the analysis result of an almost identical, already analyzed text
+
+import copy
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from bilge import metrics
+
+FINGERPRINT_BITS = 64
+
+
+def simhash(text):
+    """
+        64 bit SimHash of the text's words and word bigrams (case insensitive),
+        texts that share most of their features have fingerprints with few different bits
+    """
+    tokens = text.lower().split()
+    features = tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+    hashes = np.array([int.from_bytes(hashlib.blake2b(f.encode('utf8'), digest_size=8).digest(), 'little')
+                       for f in features], dtype=np.uint64)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    votes = bits.sum(axis=0) * 2 > len(features)
+    return int.from_bytes(np.packbits(votes, bitorder='little').tobytes(), 'little')
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class NearDuplicateIndex:
+    def __init__(self, model_id, threshold=0.9, max_entries=50000, min_tokens=8):
+        """
+            In-process index of the fingerprints of analyzed texts and their results, keeps the last
+            'max_entries' texts. Two texts are near-duplicates if at least 'threshold' of their fingerprint
+            bits are equal. Texts shorter than 'min_tokens' words aren't indexed (too few features)
+        """
+        self.model_id = model_id
+        self.max_distance = int((1 - threshold) * FINGERPRINT_BITS)
+        self.max_entries = max_entries
+        self.min_tokens = min_tokens
+
+        # fingerprints within 'max_distance' bits share at least one of 'max_distance + 1' bands
+        band_count = self.max_distance + 1
+        bounds = [FINGERPRINT_BITS * i // band_count for i in range(band_count + 1)]
+        self.bands = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self.buckets = [{} for _ in self.bands]  # band value -> fingerprints
+        self.entries = OrderedDict()  # fingerprint -> result
+
+    def fingerprint(self, text):
+        if len(text.split()) < self.min_tokens:
+            return None
+        return simhash(text)
+
+    def band_values(self, fingerprint):
+        return [(fingerprint >> start) & mask for start, mask in self.bands]
+
+    def find(self, fingerprint):
+        for bucket, value in zip(self.buckets, self.band_values(fingerprint)):
+            for candidate in bucket.get(value, ()):
+                if hamming_distance(candidate, fingerprint) <= self.max_distance:
+                    self.entries.move_to_end(candidate)
+                    return self.entries[candidate]
+        return None
+
+    def add(self, fingerprint, result):
+        if fingerprint in self.entries:
+            self.entries.move_to_end(fingerprint)
+            return
+
+        self.entries[fingerprint] = result
+        for bucket, value in zip(self.buckets, self.band_values(fingerprint)):
+            bucket.setdefault(value, set()).add(fingerprint)
+
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            for bucket, value in zip(self.buckets, self.band_values(evicted)):
+                bucket[value].discard(evicted)
+                if not bucket[value]:
+                    del bucket[value]
+
+    def get_or_compute(self, texts, compute):
+        """
+            Returns the results for the texts in order, a text with an indexed near-duplicate gets a copy of
+            its result, 'compute' (list of texts -> list of results) runs only for the others
+        """
+        fingerprints = [self.fingerprint(t) for t in texts]
+        results = [None] * len(texts)
+        missing = []
+        for i, fingerprint in enumerate(fingerprints):
+            result = self.find(fingerprint) if fingerprint is not None else None
+            if result is None:
+                missing.append(i)
+            else:
+                results[i] = copy.deepcopy(result)
+
+        if missing:
+            for i, result in zip(missing, compute([texts[i] for i in missing])):
+                results[i] = result
+                if fingerprints[i] is not None:
+                    self.add(fingerprints[i], copy.deepcopy(result))
+
+        skipped = len(texts) - len(missing)
+        if skipped > 0:
+            metrics.near_duplicate_hits.inc(skipped, model=self.model_id)
+        return results
@@ -0,0 +1,283 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Local inference servers : one process per model, shared by every celery worker process over a unix socket
+#  python -m bilge.inference
+
+import multiprocessing
+import os
+import queue
+import secrets
+import threading
+import time
+from functools import lru_cache
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import bilge
+from bilge import metrics
+from bilge.logger import logging
+
+config = bilge.config
+
+
+def socket_dir():
+    # 'inference_socket_dir', or bilge/ in the service's runtime directory
+    # (systemd's RuntimeDirectory, $XDG_RUNTIME_DIR)
+    directory = getattr(config, 'inference_socket_dir', None)
+    if directory:
+        return directory
+    runtime = os.environ.get('RUNTIME_DIRECTORY', '').split(':')[0] or os.environ.get('XDG_RUNTIME_DIR')
+    return os.path.join(runtime, 'bilge') if runtime else os.path.abspath(os.path.join('run', 'bilge'))
+
+
+def check_socket_dir():
+    # creates the socket directory (0700), refuses a directory of another user or one that others can access
+    directory = socket_dir()
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f'{directory} must be owned by uid {os.getuid()} with mode 0700 '
+                              f'(owner uid {st.st_uid}, mode {oct(st.st_mode & 0o777)})')
+    return directory
+
+
+@lru_cache(maxsize=None)
+def authkey():
+    """
+        Key of the servers' and workers' connection handshake : 'inference_authkey',
+        or a random key in the socket directory's 'authkey' file, created (0600) by the first process
+    """
+    key = getattr(config, 'inference_authkey', None)
+    if key:
+        return key.encode()
+
+    path = os.path.join(check_socket_dir(), 'authkey')
+    if not os.path.exists(path):
+        # written to a temporary file and linked in place, so other processes never read a partial key
+        tmp_path = f'{path}.{os.getpid()}'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secrets.token_bytes(32))
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def socket_path(task, language):
+    return os.path.join(socket_dir(), f'{task}.{language}.sock')
+
+
+def model_list():
+    # models to serve, 'inference_models' (e.g. ["sentiment:en", "ner:en"]) or every analyzer
+    from bilge.tasks import analyzer_factories
+    models = getattr(config, 'inference_models', None)
+    if not models:
+        return list(analyzer_factories)
+    return [tuple(m.split(':')) for m in models]
+
+
+def wait_for_servers(models, timeout=600, interval=1.0):
+    # blocks until the servers of 'models' accept connections (the models are loaded before the servers listen),
+    # returns the models still unavailable after 'timeout' seconds
+    deadline = time.monotonic() + timeout
+    pending = list(models)
+    while True:
+        for task, language in list(pending):
+            try:
+                conn = Client(socket_path(task, language), family='AF_UNIX', authkey=authkey())
+                conn.recv()
+                conn.close()
+                pending.remove((task, language))
+            except (EOFError, OSError):
+                pass
+        if not pending or time.monotonic() >= deadline:
+            return pending
+        time.sleep(interval)
+
+
+class Request:
+    def __init__(self, texts):
+        self.texts = texts
+        self.response = None
+        self.done = threading.Event()
+
+
+class InferenceServer:
+    def __init__(self, task, language, max_batch_size=256, max_latency=0.01):
+        """
+            Serves one analyzer on a unix socket. Requests of all the connected workers are queued
+            and merged into batches of up to 'max_batch_size' texts, a batch waits at most 'max_latency'
+            seconds for more requests after its first one
+        """
+        self.task = task
+        self.language = language
+        self.address = socket_path(task, language)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.analyzer = None
+
+    def compute(self, texts):
+        if self.task == 'ner':
+            return list(self.analyzer.get_named_entities_batch(texts))
+        return self.analyzer.get_sentiments(texts)
+
+    def serve(self):
+        from bilge.tasks import analyzer_factories
+        self.analyzer = analyzer_factories[(self.task, self.language)]()
+
+        check_socket_dir()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        listener = Listener(self.address, family='AF_UNIX', authkey=authkey())
+        threading.Thread(target=self.batch_loop, daemon=True).start()
+        logging.info(f'[Bilge:Inference] Serving {self.analyzer.model_id} on {self.address}')
+
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError) as e:
+                logging.warning(f'[Bilge:Inference] Rejected a connection on {self.address} : {e!r}')
+                continue
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        # one thread per worker connection, the worker sends a list of texts and waits for the results
+        try:
+            conn.send(self.analyzer.model_id)
+            while True:
+                request = Request(conn.recv())
+                self.requests.put(request)
+                request.done.wait()
+                conn.send(request.response)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        size = len(batch[0].texts)
+        deadline = time.monotonic() + self.max_latency
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def batch_loop(self):
+        while True:
+            batch = self.next_batch()
+            texts = [t for request in batch for t in request.texts]
+            metrics.inference_batch_size.observe(len(texts), model=self.analyzer.model_id)
+            try:
+                results = self.compute(texts)
+                responses = []
+                for request in batch:
+                    responses.append(('ok', results[:len(request.texts)]))
+                    results = results[len(request.texts):]
+            except Exception as e:
+                logging.warning(f'[Bilge:Inference] Could not run the batch of {len(texts)} texts : {e}')
+                responses = [('error', str(e))] * len(batch)
+
+            for request, response in zip(batch, responses):
+                request.response = response
+                request.done.set()
+
+
+class RemoteAnalyzer:
+    def __init__(self, task, language, retries=5, backoff=0.5):
+        """
+            Stands in for an analyzer in the worker process, forwards the texts to the model's
+            inference server. Connects on first use, and again after a fork or a dropped connection.
+            While the server is unavailable (starting or restarting) a request is retried 'retries' times,
+            waiting 'backoff' seconds doubled after each attempt
+        """
+        self.task = task
+        self.language = language
+        self.address = socket_path(task, language)
+        self.retries = retries
+        self.backoff = backoff
+        self.conn = None
+        self.pid = None
+        self.remote_model_id = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = Client(self.address, family='AF_UNIX', authkey=authkey())
+            self.pid = os.getpid()
+            self.remote_model_id = self.conn.recv()
+
+    def request(self, texts=None):
+        # connects (and sends the texts), on a new connection with backoff while the server is unavailable
+        for attempt in range(self.retries + 1):
+            try:
+                self.connect()
+                if texts is None:
+                    return None
+                self.conn.send(list(texts))
+                return self.conn.recv()
+            except (EOFError, OSError) as e:
+                self.conn = None
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logging.warning(f'[Bilge:Inference] {self.address} is unavailable ({e}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    @property
+    def model_id(self):
+        with self.lock:
+            self.request()
+            return self.remote_model_id
+
+    def call(self, texts):
+        with self.lock:
+            status, result = self.request(texts)
+        if status != 'ok':
+            raise RuntimeError(f"inference server error ({self.task}.{self.language}) : {result}")
+        return result
+
+    def get_sentiments(self, texts):
+        return self.call(texts) if len(texts) > 0 else []
+
+    def get_sentiment(self, text):
+        return self.get_sentiments([text])[0]
+
+    def get_named_entities_batch(self, texts):
+        return iter(self.call(texts))
+
+    def get_named_entities(self, text):
+        entities = next(self.get_named_entities_batch([text]))
+        return [{"entity": e[0], "label": e[1]} for e in entities]
+
+
+def run_server(task, language, metrics_port):
+    metrics.start_server(metrics_port)
+    InferenceServer(task, language,
+                    max_batch_size=getattr(config, 'inference_max_batch_size', 256),
+                    max_latency=getattr(config, 'inference_max_latency', 0.01)).serve()
+
+
+if __name__ == "__main__":
+    base_port = getattr(config, 'inference_metrics_port', 0)
+    processes = []
+    for idx, (task, language) in enumerate(model_list()):
+        p = multiprocessing.Process(target=run_server, args=(task, language, base_port + idx if base_port else 0),
+                                    name=f'bilge-inference-{task}.{language}')
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
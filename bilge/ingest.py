@@ -0,0 +1,296 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Asyncio ingestion service : an alternative to Bilge.start_listening's pub/sub thread
+
+import asyncio
+import json
+import os
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import bilge
+from bilge import database, metrics
+from bilge.batching import PostAccumulator
+from bilge.logger import logging
+from bilge.tasks import all_queues
+
+config = bilge.config
+
+POST_FIELDS = ('ID', 'CreatedAt', 'UpdatedAt', 'DeletedAt', 'Title', 'Author', 'Source', 'Text', 'Url',
+               'Timestamp', 'Score', 'Language')
+# payloads larger than this are decoded off the event loop
+LARGE_PAYLOAD_SIZE = 64 * 1024
+
+
+def validate_posts(data):
+    # keep the posts that have every field redis_post_to_model_dict reads
+    if not isinstance(data, list):
+        raise ValueError(f"expected a list of posts, got {type(data).__name__}")
+
+    posts = [p for p in data if isinstance(p, dict) and all(f in p for f in POST_FIELDS)]
+    if len(posts) < len(data):
+        logging.warning(f'[Bilge:Ingest] Skipped {len(data) - len(posts)} malformed posts')
+    return posts
+
+
+def release_after(fn, *args):
+    # runs 'fn' in the thread pool, the thread's pooled db connection goes back to the pool afterwards
+    try:
+        return fn(*args)
+    finally:
+        database.release_connection()
+
+
+class AsyncIngestion:
+    def __init__(self, bilge_instance):
+        """
+            Reads 'new_posts' with the async redis client, decodes/validates messages without blocking the loop,
+            dispatches batches to celery from a thread pool and runs the backlog scans off the loop.
+            'bilge_instance' (main.Bilge) provides the dispatch and backlog scan logic
+        """
+        self.bilge = bilge_instance
+        self.executor = ThreadPoolExecutor(max_workers=getattr(config, 'ingest_dispatch_threads', 4))
+        self.queue_depth = 0
+        self.in_flight = set()
+        self.stop_event = None
+        self.loop = None
+
+        self.accumulator = PostAccumulator(self.dispatch,
+                                           max_batch_size=getattr(config, 'batch_max_size', 64),
+                                           max_latency=getattr(config, 'batch_max_latency', 2.0),
+                                           queue_depth=lambda: self.queue_depth,
+                                           max_queue_depth=getattr(config, 'batch_max_queue_depth', 1000),
+                                           max_buffered=getattr(config, 'batch_max_buffered', 5000))
+
+    def dispatch(self, posts):
+        # called on the loop by the accumulator, sending to the broker happens in the thread pool
+        future = self.loop.run_in_executor(self.executor, release_after, self.bilge.dispatch_posts, posts)
+        self.in_flight.add(future)
+        future.add_done_callback(lambda f: self.dispatch_done(f, posts))
+        return future
+
+    def dispatch_done(self, future, posts):
+        self.in_flight.discard(future)
+        if future.exception() is not None:
+            logging.warning(f'[Bilge:Ingest] Could not send the posts to the workers : {future.exception()}')
+
+    async def decode_posts(self, data):
+        if len(data) > LARGE_PAYLOAD_SIZE:
+            data = await self.loop.run_in_executor(self.executor, json.loads, data)
+        else:
+            data = json.loads(data)
+        return [self.bilge.redis_post_to_model_dict(p) for p in validate_posts(data)]
+
+    async def listen(self, redis_client):
+        pubsub = redis_client.pubsub()
+        await pubsub.psubscribe('new_posts')
+        logging.info('[Bilge:Ingest] Started listening "new_posts"')
+        try:
+            while not self.stop_event.is_set():
+                # waits on the socket (no polling) for up to a second, then checks for shutdown
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                try:
+                    self.accumulator.add(await self.decode_posts(message['data']))
+                except Exception as e:
+                    logging.warning(f'[Bilge:Ingest] Could not handle the message : {e}')
+        finally:
+            await pubsub.punsubscribe('new_posts')
+            await pubsub.close()
+
+    async def flush_loop(self):
+        # flush the batches whose latency deadline passed
+        while not self.stop_event.is_set():
+            await asyncio.sleep(self.accumulator.max_latency / 4)
+            self.accumulator.flush_ready()
+
+    async def queue_depth_loop(self, redis_client):
+        while not self.stop_event.is_set():
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for queue in all_queues():
+                    pipe.llen(queue)
+                self.queue_depth = sum(await pipe.execute())
+                metrics.queue_depth.set(self.queue_depth)
+                metrics.buffered_posts.set(self.accumulator.buffered())
+            except Exception as e:
+                logging.warning(f'[Bilge:Ingest] Could not get the queue depth : {e}')
+            await asyncio.sleep(1)
+
+    async def backlog_loop(self):
+        # the backlog queries are synchronous (peewee), run them in the thread pool
+        while not self.stop_event.is_set():
+            await self.loop.run_in_executor(self.executor, release_after, self.bilge.update_missing_nlp_analysis)
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=self.bilge.backlog_scan_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        import aioredis
+
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(sig, self.stop_event.set)
+
+        redis_client = aioredis.Redis(host=config.redis_host, port=config.redis_port, db=config.redis_db)
+        try:
+            await asyncio.gather(self.listen(redis_client), self.flush_loop(),
+                                 self.queue_depth_loop(redis_client), self.backlog_loop())
+        finally:
+            self.stop_event.set()
+            # graceful shutdown : drain the buffer and wait for the in-flight dispatches
+            logging.info('[Bilge:Ingest] Shutting down, draining the buffered posts')
+            self.accumulator.stop()
+            while self.in_flight:
+                await asyncio.gather(*list(self.in_flight), return_exceptions=True)
+            self.executor.shutdown(wait=True)
+            await redis_client.close()
+            logging.info('[Bilge:Ingest] Stopped')
+
+
+def next_entry_id(entry_id):
+    # the smallest stream entry id after 'entry_id' ("<ms>-<seq>"), for exclusive range starts
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, seq = entry_id.split('-')
+    return f'{ms}-{int(seq) + 1}'
+
+
+class StreamIngestion(AsyncIngestion):
+    def __init__(self, bilge_instance):
+        """
+            Reads posts from a redis stream (entries with a 'data' field holding the same json list of posts
+            as the pub/sub messages) as a member of a consumer group, so several listeners can share the stream.
+            An entry is acknowledged once all of its posts are sent to celery. Entries left pending
+            (crashed consumers, dropped or failed dispatches) are claimed after 'stream_claim_idle' seconds.
+            No entries are read or claimed while the accumulator is backpressured or full, they wait in the stream
+        """
+        super().__init__(bilge_instance)
+        self.stream = getattr(config, 'stream_name', 'new_posts')
+        self.group = getattr(config, 'stream_group', 'bilge')
+        self.consumer = f'{socket.gethostname()}-{os.getpid()}'
+        self.read_count = getattr(config, 'stream_read_count', 100)
+        self.claim_idle = getattr(config, 'stream_claim_idle', 300)
+
+        self.redis_client = None
+        self.entry_remaining = {}  # stream entry id -> posts not yet sent
+        self.accumulator.on_drop = self.forget_posts
+
+    def full(self):
+        return self.accumulator.backpressured() or self.accumulator.buffered() >= self.accumulator.max_buffered
+
+    def forget_posts(self, posts):
+        # the entries of these posts stay pending, they will be claimed and retried
+        self.forget_entries([p.get('_entry') for p in posts])
+
+    def forget_entries(self, entry_ids):
+        for entry_id in entry_ids:
+            self.entry_remaining.pop(entry_id, None)
+
+    def dispatch(self, posts):
+        # the buffered posts carry their stream entry id ('_entry'), the workers get the posts without it
+        entry_ids = [p.pop('_entry', None) for p in posts]
+        future = super().dispatch(posts)
+        future.add_done_callback(lambda f: self.entries_done(f, entry_ids))
+        return future
+
+    def entries_done(self, future, entry_ids):
+        if future.exception() is not None:
+            self.forget_entries(entry_ids)
+            return
+
+        done = []
+        for entry_id in entry_ids:
+            if entry_id is not None and entry_id in self.entry_remaining:
+                self.entry_remaining[entry_id] -= 1
+                if self.entry_remaining[entry_id] == 0:
+                    del self.entry_remaining[entry_id]
+                    done.append(entry_id)
+        if done:
+            self.track(self.ack(done))
+
+    def track(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+
+    async def ack(self, entry_ids):
+        try:
+            await self.redis_client.xack(self.stream, self.group, *entry_ids)
+        except Exception as e:
+            logging.warning(f'[Bilge:Ingest] Could not acknowledge {len(entry_ids)} stream entries : {e}')
+
+    async def handle_entries(self, entries):
+        for entry_id, fields in entries:
+            try:
+                posts = await self.decode_posts(fields[b'data'])
+            except Exception as e:
+                # a malformed entry would be retried forever, acknowledge it
+                logging.warning(f'[Bilge:Ingest] Could not handle the stream entry {entry_id} : {e}')
+                posts = []
+
+            if not posts:
+                await self.ack([entry_id])
+                continue
+
+            self.entry_remaining[entry_id] = len(posts)
+            for p in posts:
+                p['_entry'] = entry_id
+            self.accumulator.add(posts)
+
+    async def create_group(self):
+        try:
+            await self.redis_client.xgroup_create(self.stream, self.group, id='$', mkstream=True)
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def claim_pending(self):
+        # walks the whole pending list in XPENDING pages of 'read_count' entries, oldest first,
+        # until the buffer is full (the rest is claimed on the next pass)
+        start = '-'
+        while not self.stop_event.is_set() and not self.full():
+            pending = await self.redis_client.xpending_range(self.stream, self.group, start, '+', self.read_count)
+            stale = [p['message_id'] for p in pending
+                     if p['message_id'] not in self.entry_remaining
+                     and p['time_since_delivered'] >= self.claim_idle * 1000]
+            if stale:
+                entries = await self.redis_client.xclaim(self.stream, self.group, self.consumer,
+                                                         self.claim_idle * 1000, stale)
+                logging.info(f'[Bilge:Ingest] Claimed {len(entries)} pending stream entries')
+                await self.handle_entries([e for e in entries if e[1] is not None])
+            if len(pending) < self.read_count:
+                break
+            start = next_entry_id(pending[-1]['message_id'])
+
+    async def claim_loop(self):
+        # take over the entries left pending for too long (by crashed consumers, or dropped/failed here)
+        while not self.stop_event.is_set():
+            try:
+                await self.claim_pending()
+            except Exception as e:
+                logging.warning(f'[Bilge:Ingest] Could not claim the pending stream entries : {e}')
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=self.claim_idle / 2)
+            except asyncio.TimeoutError:
+                pass
+
+    async def listen(self, redis_client):
+        self.redis_client = redis_client
+        await self.create_group()
+        logging.info(f'[Bilge:Ingest] Reading stream "{self.stream}" as {self.consumer} (group "{self.group}")')
+        claim_task = self.loop.create_task(self.claim_loop())
+        try:
+            while not self.stop_event.is_set():
+                if self.full():
+                    await asyncio.sleep(self.accumulator.max_latency / 4)
+                    continue
+                response = await redis_client.xreadgroup(self.group, self.consumer, {self.stream: '>'},
+                                                         count=self.read_count, block=1000)
+                for _, entries in response or []:
+                    await self.handle_entries(entries)
+        finally:
+            await claim_task
@@ -0,0 +1,93 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Language identification of the posts before they are sent to the workers (fasttext lid.176)
+
+import bilge
+from bilge import database, metrics
+from bilge.logger import logging
+
+config = bilge.config
+
+LABEL_PREFIX = '__label__'
+
+
+class LanguageIdentifier:
+    def __init__(self, model_path='models/lid.176.ftz', max_chars=1000, min_confidence=0.5, override_confidence=0.9):
+        """
+            Character n-gram language identifier (fasttext's compressed lid.176 model, ~1MB).
+            A missing language is filled in when the prediction's probability is at least 'min_confidence',
+            a language given by the source is replaced only above 'override_confidence'
+        """
+        import fasttext
+        self.model = fasttext.load_model(model_path)
+        self.max_chars = max_chars
+        self.min_confidence = min_confidence
+        self.override_confidence = override_confidence
+
+    def predict(self, texts):
+        # predicts the whole list in one call, returns (language, probability) per text
+        labels, probabilities = self.model.predict([t[:self.max_chars].replace('\n', ' ') for t in texts], k=1)
+        return [(l[0][len(LABEL_PREFIX):], float(p[0])) if len(l) > 0 else (None, 0.0)
+                for l, p in zip(labels, probabilities)]
+
+    def identify(self, posts):
+        """
+            Sets the 'language' of the posts (in place)
+            returns {post id : language} of the posts whose language changed
+        """
+        texts = [' '.join(filter(None, (p.get('title'), p.get('text')))).strip() for p in posts]
+        candidates = [(p, t) for p, t in zip(posts, texts) if t]
+        if not candidates:
+            return {}
+
+        changed = {}
+        for (p, _), (language, probability) in zip(candidates, self.predict([t for _, t in candidates])):
+            if language is None or language == p['language']:
+                continue
+
+            if not p['language'] and probability >= self.min_confidence:
+                metrics.language_detections.inc(result='filled', language=language)
+            elif p['language'] and probability >= self.override_confidence:
+                metrics.language_detections.inc(result='corrected', language=language)
+            else:
+                continue
+            p['language'] = language
+            changed[p['id']] = language
+        return changed
+
+
+identifier = None
+identifier_failed = False
+
+
+def get_identifier():
+    # the identifier is loaded on first use, None if 'langid_enabled' is off or the model couldn't be loaded
+    global identifier, identifier_failed
+    if identifier is None and not identifier_failed and getattr(config, 'langid_enabled', False):
+        try:
+            identifier = LanguageIdentifier(model_path=getattr(config, 'langid_model_path', 'models/lid.176.ftz'),
+                                            max_chars=getattr(config, 'langid_max_chars', 1000),
+                                            min_confidence=getattr(config, 'langid_min_confidence', 0.5),
+                                            override_confidence=getattr(config, 'langid_override_confidence', 0.9))
+        except Exception as e:
+            identifier_failed = True
+            logging.warning(f'[Bilge:LangID] Could not load the language identification model : {e}')
+    return identifier
+
+
+def identify_languages(posts):
+    # fills in/corrects the posts' languages and saves the changes, so the backlog queries see them too.
+    # part of the dispatch : when the languages can't be saved the posts get their languages back
+    # and the error is raised, so they aren't sent
+    lid = get_identifier()
+    if lid is None or not posts:
+        return
+
+    languages = [p['language'] for p in posts]
+    changed = lid.identify(posts)
+    if changed:
+        try:
+            database.db.update_post_languages(changed)
+        except Exception:
+            for p, language in zip(posts, languages):
+                p['language'] = language
+            raise
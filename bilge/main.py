@@ -1,14 +1,27 @@
 # (c) 2021 Emir Erbasan (humanova)
 #  Bilge : NLP analysis for mergen posts
 
+import threading
+import time
 import traceback
 import json
+from datetime import datetime, timedelta
+from functools import partial
 
 import redis
 
-from bilge import database
+import bilge
+from bilge import database, metrics
+from bilge.batching import PostAccumulator
 from bilge.logger import logging
-from bilge.tasks import calculate_and_insert_sentiments, calculate_and_insert_named_entities
+from bilge.langid import get_identifier, identify_languages
+from bilge.tasks import calculate_and_insert_sentiments, calculate_and_insert_named_entities, all_queues, send_posts, \
+    supported_languages
+
+config = bilge.config
+
+# posts of the backlog scan handed to send_posts at once
+BACKLOG_PAGE_SIZE = 500
 
 
 class Bilge:
@@ -18,8 +31,25 @@ class Bilge:
         self.pubsub = self.redis_client.pubsub()
         self.pubsub_thread = None
 
+        # backlog scanner, re-dispatches posts with missing analysis on its own schedule
+        self.backlog_scan_interval = getattr(config, 'backlog_scan_interval', 60)
+        self.backlog_scan_limit = getattr(config, 'backlog_scan_limit', 1500)
+        self.backlog_recheck_delay = getattr(config, 'backlog_recheck_delay', 3600)
+        self.backlog_positions = {}  # scan name -> [(time, scan position)] of the recent scans
+        self.backlog_thread = None
+        self.backlog_stop_event = threading.Event()
+
+        # buffers the incoming posts, sends them to the workers in batches per language
+        self.accumulator = PostAccumulator(self.dispatch_posts,
+                                           max_batch_size=getattr(config, 'batch_max_size', 64),
+                                           max_latency=getattr(config, 'batch_max_latency', 2.0),
+                                           queue_depth=self.get_queue_depth,
+                                           max_queue_depth=getattr(config, 'batch_max_queue_depth', 1000),
+                                           max_buffered=getattr(config, 'batch_max_buffered', 5000))
+
     def start_listening(self):
         # start listening 'new_posts' pub/sub channel
+        self.accumulator.start()
         self.pubsub.psubscribe(**{'new_posts':self.post_handler})
         self.pubsub_thread = self.pubsub.run_in_thread(sleep_time=0.001)
         logging.info('[Bilge] Started listening "new_posts"')
@@ -30,41 +60,140 @@ class Bilge:
             self.pubsub_thread.stop()
             self.pubsub_thread = None
             self.pubsub.punsubscribe('new_posts')
+            self.accumulator.stop()
             logging.info('[Bilge] Stopped listening "new_posts"')
 
+    def start_backlog_scanner(self):
+        self.backlog_stop_event.clear()
+        self.backlog_thread = threading.Thread(target=self.backlog_scanner_loop, daemon=True)
+        self.backlog_thread.start()
+        logging.info(f'[Bilge] Started the backlog scanner (every {self.backlog_scan_interval}s)')
+
+    def stop_backlog_scanner(self):
+        if self.backlog_thread is not None:
+            self.backlog_stop_event.set()
+            self.backlog_thread.join()
+            self.backlog_thread = None
+            logging.info('[Bilge] Stopped the backlog scanner')
+
+    def backlog_scanner_loop(self):
+        while True:
+            self.update_missing_nlp_analysis()
+            if self.backlog_stop_event.wait(self.backlog_scan_interval):
+                break
+
     def post_handler(self, post_message):
         # handle pubsub messages : 
-        # unmarshal the posts, calculate the sentiments, update the sentiment table
-        self.update_missing_nlp_analysis()
+        # unmarshal the posts and buffer them until a batch is ready
         try:
             posts = [self.redis_post_to_model_dict(p) for p in json.loads(post_message['data'])]
-            calculate_and_insert_sentiments.delay(posts)
-            calculate_and_insert_named_entities.delay(slice)
+            self.accumulator.add(posts)
         except Exception as e:
             logging.warning(f'[Bilge] Could not calculate/insert the sentiments of the posts : {e}')
             traceback.print_tb(e.__traceback__)
 
+    def dispatch_posts(self, posts):
+        # send a batch of posts (of the same language) to the workers,
+        # after filling in/correcting their languages
+        identify_languages(posts)
+        send_posts(calculate_and_insert_sentiments, posts)
+        send_posts(calculate_and_insert_named_entities, posts)
+
+    def get_queue_depth(self):
+        # number of tasks waiting in the celery queues (the broker is on the same redis db)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for queue in all_queues():
+            pipe.llen(queue)
+        depth = sum(pipe.execute())
+        metrics.queue_depth.set(depth)
+        metrics.buffered_posts.set(self.accumulator.buffered())
+        return depth
+
     def update_missing_nlp_analysis(self):
-        # handle posts with missing sentiment data
-        # query 'limit' number of posts, calculate the sentiments, update the sentiment table
+        # handle posts with missing sentiment/named entity data
+        # walk the backlog from the last scan position and send the posts to the workers in slices,
+        # posts without a language are included when they can be identified
+        include_unknown = get_identifier() is not None
+        self.scan_backlog('sentiment',
+                          partial(database.db.get_posts_without_sentiment, languages=supported_languages('sentiment'),
+                                  include_unknown=include_unknown),
+                          calculate_and_insert_sentiments)
+        self.scan_backlog('named_entity',
+                          partial(database.db.get_posts_without_named_entity, languages=supported_languages('ner'),
+                                  include_unknown=include_unknown),
+                          calculate_and_insert_named_entities)
+
+    def backlog_recheck_bound(self, name, position):
+        # the scan position of 'backlog_recheck_delay' seconds ago (None until the scanner ran that long) :
+        # the posts dispatched up to it had time to be analyzed
+        now = time.monotonic()
+        history = self.backlog_positions.setdefault(name, [])
+        history.append((now, position))
+        old = [idx for idx, (t, _) in enumerate(history) if now - t >= self.backlog_recheck_delay]
+        if not old:
+            return None
+        del history[:old[-1]]
+        return history[0][1]
+
+    def dispatch_backlog(self, get_posts, task, before_date, after_id, until_id=None):
+        # sends up to 'backlog_scan_limit' posts after 'after_id' in keyset pages,
+        # returns (number of posts sent, last post id)
+        scanned = 0
+        while scanned < self.backlog_scan_limit:
+            limit = min(BACKLOG_PAGE_SIZE, self.backlog_scan_limit - scanned)
+            page = list(get_posts(limit=limit, before_date=before_date, after_id=after_id, until_id=until_id).dicts())
+            if not page:
+                break
+            scanned += len(page)
+            after_id = page[-1]['id']
+            identify_languages(page)
+            send_posts(task, page)
+            if len(page) < limit:
+                break
+        return scanned, after_id
+
+    def scan_backlog(self, name, get_posts, task):
         try:
-            # 150 posts (as dict) in 10 slices
-            s_posts = [database.post_to_dict(p) for p in database.db.get_posts_without_sentiment(limit=150)]
-            n_posts = [database.post_to_dict(p) for p in database.db.get_posts_without_named_entity(limit=150)]
-            sentiment_slices = [s_posts[x:x + 15] for x in range(0, len(s_posts), 15)]
-            ner_slices = [n_posts[x:x + 15] for x in range(0, len(n_posts), 15)]
-
-            for slice in sentiment_slices:
-                calculate_and_insert_sentiments.delay(slice)
-
-            for slice in ner_slices:
-                calculate_and_insert_named_entities.delay(slice)
+            before_date = datetime.utcnow() - timedelta(hours=1)
+            last_post_id = database.db.get_scan_position(name)
+            scanned, last_post_id = self.dispatch_backlog(get_posts, task, before_date, last_post_id)
+
+            # reached the end of the backlog, skip the already analyzed posts up to the cutoff
+            if scanned < self.backlog_scan_limit:
+                last_post_id = max(last_post_id, database.db.get_last_post_id(before_date))
+            database.db.set_scan_position(name, last_post_id)
+
+            # the scan position skips every dispatched post : a second, lagging position goes over the posts
+            # again up to the scan position of 'backlog_recheck_delay' seconds ago, and sends the ones
+            # still missing their results (failed or lost tasks)
+            bound = self.backlog_recheck_bound(name, last_post_id)
+            if bound is not None:
+                recheck_name = f'{name}:recheck'
+                recheck_id = database.db.get_scan_position(recheck_name, default=None)
+                # a new recheck position starts at the bound, the older posts were scanned before
+                recheck_id = bound if recheck_id is None else recheck_id
+                if recheck_id < bound:
+                    rechecked, recheck_id = self.dispatch_backlog(get_posts, task, before_date, recheck_id,
+                                                                  until_id=bound)
+                    if rechecked < self.backlog_scan_limit:
+                        recheck_id = bound
+                    if rechecked:
+                        logging.info(f'[Bilge] Backlog recheck ({name}) : dispatched {rechecked} posts again')
+                database.db.set_scan_position(recheck_name, recheck_id)
+
+            backlog_size = get_posts(limit=None, before_date=before_date, after_id=last_post_id).count()
+            metrics.backlog_size.set(backlog_size, kind=name)
+            logging.info(f'[Bilge] Backlog scan ({name}) : dispatched {scanned} posts, '
+                         f'{backlog_size} remaining after post id {last_post_id}')
 
         except Exception as e:
-            logging.warning(f'[Bilge] Could not send missing sentiments to the worker : {e}')
+            logging.warning(f'[Bilge] Could not send missing {name} posts to the worker : {e}')
             traceback.print_tb(e.__traceback__)
+        finally:
+            database.release_connection()
 
-    def redis_post_to_model_dict(self, post:dict):
+    @staticmethod
+    def redis_post_to_model_dict(post:dict):
         return {'id': post['ID'],
                 'created_at' : post['CreatedAt'],
                 'updated_at': post['UpdatedAt'],
@@ -86,7 +215,19 @@ if __name__ == "__main__":
     try:
         redis_client = redis.Redis(host= config.redis_host, port=config.redis_port, db=config.redis_db)
         bilge = Bilge(redis_client)
-        bilge.start_listening()
+        metrics.start_server(getattr(config, 'metrics_port', 0))
+
+        # 'pubsub' : listener thread, 'async' : asyncio ingestion service,
+        # 'stream' : redis stream consumer group (bilge.ingest)
+        ingestion_mode = getattr(config, 'ingestion_mode', 'pubsub')
+        if ingestion_mode in ('async', 'stream'):
+            import asyncio
+            from bilge.ingest import AsyncIngestion, StreamIngestion
+            service = StreamIngestion(bilge) if ingestion_mode == 'stream' else AsyncIngestion(bilge)
+            asyncio.run(service.run())
+        else:
+            bilge.start_listening()
+            bilge.start_backlog_scanner()
     except Exception as e:
         traceback.print_tb(e.__traceback__)
         logging.fatal(f"[Bilge] Couldn't initialize bilge : {e}")
@@ -0,0 +1,146 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Prometheus-style metrics, served as text over a local http endpoint
+
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bilge.logger import logging
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+registry = []
+
+
+def format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}  # sorted label pairs -> value
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            for labels, value in self.values.items():
+                lines.append(f'{self.name}{format_labels(labels)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                for bound, n in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{format_labels(labels, ("le", bound))} {n}')
+                lines.append(f'{self.name}_bucket{format_labels(labels, ("le", "+Inf"))} {count}')
+                lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+                lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+        return lines
+
+
+def render():
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, host='0.0.0.0'):
+    # serve the metrics on http://host:port/ from a daemon thread, port 0 disables it
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logging.warning(f'[Bilge:Metrics] Could not start the metrics endpoint on port {port} : {e}')
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f'[Bilge:Metrics] Serving metrics on port {port}')
+    return server
+
+
+# -- metrics --
+tokenization_seconds = Histogram('bilge_tokenization_seconds', 'Time spent tokenizing a batch')
+model_forward_seconds = Histogram('bilge_model_forward_seconds', 'Time spent in a model forward pass (per batch)')
+db_write_seconds = Histogram('bilge_db_write_seconds', 'Time spent writing analysis results to the db')
+batch_size = Histogram('bilge_batch_size', 'Number of posts per task', buckets=SIZE_BUCKETS)
+task_seconds = Histogram('bilge_task_seconds', 'Task run time')
+task_failures = Counter('bilge_task_failures_total', 'Number of failed tasks')
+backlog_size = Gauge('bilge_backlog_size', 'Posts missing analysis after the last backlog scan')
+cache_lookups = Counter('bilge_cache_lookups_total', 'Inference cache lookups by result (hits_lru, hits_redis, misses)')
+queue_depth = Gauge('bilge_queue_depth', 'Tasks waiting in the celery queues')
+buffered_posts = Gauge('bilge_buffered_posts', 'Posts waiting in the listener batch buffer')
+inference_batch_size = Histogram('bilge_inference_batch_size', 'Number of texts per inference server batch',
+                                 buckets=SIZE_BUCKETS)
+language_detections = Counter('bilge_language_detections_total',
+                              'Post languages filled in or corrected by the language identifier')
+near_duplicate_hits = Counter('bilge_near_duplicate_hits_total',
+                              'Inferences skipped by reusing the result of a near-duplicate text')
+token_budget = Gauge('bilge_token_budget', 'Estimated tokens per task of the backlog/dispatch scheduler, per model')
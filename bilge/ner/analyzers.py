@@ -1,18 +1,103 @@
+import itertools
+import time
+
 import spacy
 
+from bilge import metrics
+
+# pipeline components that the ner component doesn't depend on
+UNUSED_PIPES = ["tagger", "parser", "attribute_ruler", "lemmatizer"]
+WINDOW_CHARS = 2000
+WINDOW_OVERLAP = 200
+
+
+def split_windows(text, size=WINDOW_CHARS, overlap=WINDOW_OVERLAP):
+    """
+        Split the text into windows of at most 'size' chars, consecutive windows share about 'overlap' chars.
+        Windows are cut at whitespace when possible so that words aren't split
+        returns a list of (offset, window text), a text always has at least one window
+    """
+    windows = []
+    start = 0
+    while start + size < len(text):
+        end = start + size
+        # the cut has to leave more than 'overlap' chars to the window, or the next one wouldn't move forward
+        cut = max(text.rfind(' ', start + overlap + 1, end), text.rfind('\n', start + overlap + 1, end))
+        if cut == -1:
+            cut = end
+        windows.append((start, text[start:cut]))
+
+        next_start = cut - overlap
+        space = max(text.rfind(' ', next_start, cut), text.rfind('\n', next_start, cut))
+        start = space + 1 if next_start < space + 1 <= cut else next_start
+    windows.append((start, text[start:]))
+    return windows
+
+
+def merge_entities(entities):
+    """
+        Entities in the overlap of two windows are found twice, and a window edge can cut an entity short :
+        of the overlapping (entity_text, label, start, end) spans, keep the longest
+    """
+    merged = []
+    for e in sorted(entities, key=lambda e: (e[2], e[2] - e[3])):
+        if merged and e[2] < merged[-1][3]:
+            if e[3] - e[2] > merged[-1][3] - merged[-1][2]:
+                merged[-1] = e
+            continue
+        merged.append(e)
+    return merged
+
 
 class EnglishNERAnalyzer:
-    def __init__(self):
+    NAME = "en_core_web_trf"
+
+    @classmethod
+    def versioned_model_id(cls, **_):
+        # the model id of the analyzer's results, from the installed package's version (without loading it)
+        return f"{cls.NAME}-{spacy.util.get_package_version(cls.NAME)}"
+
+    def __init__(self, batch_size=32, n_process=1, window_chars=WINDOW_CHARS, window_overlap=WINDOW_OVERLAP):
         """
             Initialize the NER model
+            long texts are split into overlapping windows of 'window_chars' chars
         """
-        self.model = spacy.load("en_core_web_trf")
+        self.model = spacy.load(self.NAME, disable=UNUSED_PIPES)
+        self.model_id = f"{self.NAME}-{self.model.meta['version']}"
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.window_chars = window_chars
+        self.window_overlap = window_overlap
 
     def get_named_entities(self, text):
-        doc = self.model(text)
+        entities = next(self.get_named_entities_batch([text]))
+        return [{"entity": e[0], "label": e[1]} for e in entities]
 
-        entities = []
-        for entity in doc.ents:
-            entities.append({"entity": entity, "label": entity.label_})
+    def pipe(self, texts):
+        # only the pipe's time is measured, not the consumer's time between documents
+        docs = iter(self.model.pipe(texts, batch_size=self.batch_size, n_process=self.n_process))
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                doc = next(docs, None)
+                elapsed += time.perf_counter() - start
+                if doc is None:
+                    break
+                yield doc
+        finally:
+            metrics.model_forward_seconds.observe(elapsed, model=self.model_id)
+
+    def get_named_entities_batch(self, texts):
+        """
+            Stream the windows of the texts through the pipeline (windows of different texts share batches)
+            yields a list of (entity_text, label, start, end) tuples for each text, in order
+        """
+        windows = [(idx, offset, window) for idx, text in enumerate(texts)
+                   for offset, window in split_windows(text, self.window_chars, self.window_overlap)]
+        docs = self.pipe(w[2] for w in windows)
 
-        return entities
+        for _, group in itertools.groupby(zip(windows, docs), key=lambda item: item[0][0]):
+            entities = [(e.text, e.label_, offset + e.start_char, offset + e.end_char)
+                        for (_, offset, _), doc in group for e in doc.ents]
+            yield merge_entities(entities)
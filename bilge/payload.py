@@ -0,0 +1,42 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Task payloads : the posts of an analysis task as full dicts, packed rows or post ids ('task_payload')
+
+from bilge import database
+
+PAYLOAD_MODES = ('dict', 'packed', 'ids')
+
+# the fields the analysis tasks read, in the order of a packed row
+PAYLOAD_FIELDS = ('id', 'source', 'language', 'title', 'text')
+LANGUAGE_INDEX = PAYLOAD_FIELDS.index('language')
+
+
+def encode_payload(posts, mode='dict'):
+    """
+        'dict'   : the post dicts as they are (json)
+        'packed' : a [id, source, language, title, text] row per post (sent with msgpack)
+        'ids'    : {'language': ..., 'ids': [...]}, the worker reads the posts from postgres
+        the posts of a payload are of one language (see tasks.send_posts)
+    """
+    if mode == 'ids':
+        return {'language': posts[0]['language'], 'ids': [p['id'] for p in posts]}
+    if mode == 'packed':
+        return [[p.get(f) for f in PAYLOAD_FIELDS] for p in posts]
+    return posts
+
+
+def decode_payload(payload):
+    # the mode is told by the payload's shape, so workers take every mode while the config changes
+    if isinstance(payload, dict):
+        return database.db.get_posts_by_ids(payload['ids'])
+    return [dict(zip(PAYLOAD_FIELDS, p)) if isinstance(p, (list, tuple)) else p for p in payload]
+
+
+def payload_language(payload):
+    if isinstance(payload, dict):
+        return payload['language']
+    first = payload[0]
+    return first[LANGUAGE_INDEX] if isinstance(first, (list, tuple)) else first['language']
+
+
+def payload_size(payload):
+    return len(payload['ids']) if isinstance(payload, dict) else len(payload)
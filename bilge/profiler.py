@@ -0,0 +1,56 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Sampling profiler for tasks, writes collapsed stacks (flamegraph.pl / speedscope input)
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from bilge.logger import logging
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id, interval=0.005):
+        """
+            Samples the stack of the thread 'thread_id' every 'interval' seconds
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+def dump_path(directory, task_name, task_id):
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{task_name}-{int(time.time())}-{task_id}.collapsed')
+
+
+def log_profile(profiler, path):
+    profiler.dump(path)
+    logging.info(f'[Bilge:Profiler] Wrote {sum(profiler.samples.values())} samples to {path}')
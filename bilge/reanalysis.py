@@ -0,0 +1,105 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Re-analysis of historical posts after a model change
+#  python -m bilge.reanalysis sentiment --model cardiffnlp/twitter-roberta-base-sentiment@3f2a1c9e8b7d --rate 200
+
+import argparse
+import time
+
+import redis
+
+import bilge
+from bilge import database
+from bilge.logger import logging
+from bilge.langid import identify_languages
+from bilge.tasks import all_queues, calculate_and_insert_named_entities, calculate_and_insert_sentiments, send_posts, \
+    model_languages
+
+config = bilge.config
+
+tasks = {'sentiment': calculate_and_insert_sentiments, 'named_entity': calculate_and_insert_named_entities}
+task_types = {'sentiment': 'sentiment', 'named_entity': 'ner'}
+
+
+class Reanalysis:
+    def __init__(self, kind, model, redis_client, rate=100, page_size=500, max_queue_depth=200):
+        """
+            Sends the posts that don't have a 'kind' result from 'model' to the workers, in posts.id order.
+            Only the posts in the languages 'model' serves are sent (other languages have their own models).
+            At most 'rate' posts/sec are sent, and sending pauses while the celery queues are deeper than
+            'max_queue_depth'. The position is saved after every page, so a stopped job resumes where it left.
+            Pages are packed into tasks by send_posts' token budgets.
+            The workers replace each post's old results in a single transaction
+        """
+        self.kind = kind
+        self.model = model
+        self.task = tasks[kind]
+        self.redis_client = redis_client
+        self.rate = rate
+        self.page_size = page_size
+        self.max_queue_depth = max_queue_depth
+        self.position_name = f'reanalysis:{kind}:{model}'
+
+    def queue_depth(self):
+        pipe = self.redis_client.pipeline(transaction=False)
+        for queue in all_queues():
+            pipe.llen(queue)
+        return sum(pipe.execute())
+
+    def wait_for_workers(self):
+        while self.queue_depth() > self.max_queue_depth:
+            time.sleep(1)
+
+    def run(self):
+        languages = model_languages(task_types[self.kind], self.model)
+        if not languages:
+            logging.error(f'[Bilge:Reanalysis] No {self.kind} analyzer produces {self.model}')
+            return
+
+        last_post_id = database.db.get_scan_position(self.position_name)
+        logging.info(f'[Bilge:Reanalysis] Reanalyzing {self.kind} ({", ".join(languages)}) with {self.model}, '
+                     f'starting after post {last_post_id}')
+
+        sent = 0
+        start = time.monotonic()
+        while True:
+            query = database.db.get_posts_for_reanalysis(self.kind, self.model, self.page_size, after_id=last_post_id,
+                                                         languages=languages)
+            posts = list(database.db.stream_posts(query))
+            if not posts:
+                break
+
+            self.wait_for_workers()
+            last_post_id = posts[-1]['id']
+            # posts identified as another language belong to another model
+            identify_languages(posts)
+            posts = [p for p in posts if p['language'] in languages]
+            send_posts(self.task, posts)
+            sent += len(posts)
+
+            # throttle to 'rate' posts/sec
+            ahead = sent / self.rate - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+            database.db.set_scan_position(self.position_name, last_post_id)
+            logging.info(f'[Bilge:Reanalysis] Sent {sent} posts, at post {last_post_id}')
+
+        logging.info(f'[Bilge:Reanalysis] Done, sent {sent} posts')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="re-analyze historical posts with a new model")
+    parser.add_argument('kind', choices=list(tasks))
+    parser.add_argument('--model', required=True, help="model id the workers now produce (analyzer.model_id)")
+    parser.add_argument('--rate', type=float, default=100, help="max posts sent per second")
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--max-queue-depth', type=int, default=200)
+    parser.add_argument('--restart', action='store_true', help="start from the first post instead of resuming")
+    args = parser.parse_args()
+
+    reanalysis = Reanalysis(args.kind, args.model,
+                            redis.Redis(host=config.redis_host, port=config.redis_port, db=config.redis_db),
+                            rate=args.rate, page_size=args.page_size, max_queue_depth=args.max_queue_depth)
+    if args.restart:
+        database.db.set_scan_position(reanalysis.position_name, 0)
+    reanalysis.run()
@@ -0,0 +1,36 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Backfill of the dashboard rollups (sentiment_daily, entity_daily) and of the entity table
+#  python -m bilge.rollups [--since 2021-01-01]
+
+import argparse
+from datetime import date
+
+from bilge import database
+from bilge.logger import logging
+
+
+def intern_legacy_entities(batch_size):
+    # the converted rows no longer match, so an interrupted run continues where it stopped
+    last_id = 0
+    while True:
+        last_id = database.db.intern_legacy_entities(after_id=last_id, limit=batch_size)
+        if last_id is None:
+            break
+        logging.info(f'[Bilge:Rollups] Interned the named entities up to row {last_id}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="backfill the rollup tables and the entity table")
+    parser.add_argument('--since', type=date.fromisoformat, default=None,
+                        help="only rebuild the rollups of the posts created at/after this date (YYYY-MM-DD)")
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--skip-entities', action='store_true', help="don't intern the legacy named entity texts")
+    args = parser.parse_args()
+
+    if not args.skip_entities:
+        logging.info('[Bilge:Rollups] Interning the legacy named entity texts')
+        intern_legacy_entities(args.batch_size)
+
+    logging.info(f'[Bilge:Rollups] Rebuilding the rollups{f" since {args.since}" if args.since else ""}')
+    database.db.rebuild_rollups(since=args.since)
+    logging.info('[Bilge:Rollups] Done')
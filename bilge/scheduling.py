@@ -0,0 +1,101 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Token budget scheduling : packs posts into tasks by their estimated token count instead of a fixed post count
+
+import threading
+import time
+
+from bilge import metrics
+from bilge.logger import logging
+
+# rough characters per token of the models' subword tokenizers
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(post):
+    return (len(post.get('title') or '') + len(post.get('text') or '')) // CHARS_PER_TOKEN + 1
+
+
+class TokenBudgetScheduler:
+    def __init__(self, redis_client, target_seconds=5.0, initial_tokens=8192, min_tokens=512, max_tokens=65536,
+                 max_posts=256, refresh_interval=30, smoothing=0.3):
+        """
+            Splits the posts of a model (e.g. "sentiment.en") into tasks of about 'target_seconds' of work.
+            The workers add their tasks' estimated tokens and run times to a shared redis hash (record),
+            the scheduler turns them into a smoothed seconds/token rate per model every 'refresh_interval' seconds.
+            Until a model has observations its budget is 'initial_tokens'
+        """
+        self.redis_client = redis_client
+        self.target_seconds = target_seconds
+        self.initial_tokens = initial_tokens
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.max_posts = max_posts
+        self.refresh_interval = refresh_interval
+        self.smoothing = smoothing
+
+        self.stats_key = 'bilge:scheduler:stats'
+        self.totals = {}  # model -> (tokens, seconds) at the last computed rate
+        self.rates = {}  # model -> smoothed seconds per token
+        self.last_refresh = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, model, tokens, seconds):
+        # called by the workers after each task
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.hincrbyfloat(self.stats_key, f'{model}:tokens', tokens)
+            pipe.hincrbyfloat(self.stats_key, f'{model}:seconds', seconds)
+            pipe.execute()
+        except Exception as e:
+            logging.warning(f'[Bilge:Scheduler] Could not record the task stats : {e}')
+
+    def refresh(self):
+        try:
+            stats = {field.decode('utf8'): float(value)
+                     for field, value in self.redis_client.hgetall(self.stats_key).items()}
+        except Exception as e:
+            logging.warning(f'[Bilge:Scheduler] Could not read the task stats : {e}')
+            return
+
+        for model in {field.rsplit(':', 1)[0] for field in stats}:
+            tokens, seconds = stats.get(f'{model}:tokens', 0.0), stats.get(f'{model}:seconds', 0.0)
+            last_tokens, last_seconds = self.totals.get(model, (0.0, 0.0))
+            # rate of the tasks finished since the last computed rate, the totals only advance with a rate
+            # so that small increments add up across refreshes until there are enough tokens to be meaningful
+            if tokens - last_tokens < self.min_tokens or seconds <= last_seconds:
+                continue
+            self.totals[model] = (tokens, seconds)
+            rate = (seconds - last_seconds) / (tokens - last_tokens)
+            previous = self.rates.get(model)
+            self.rates[model] = rate if previous is None else self.smoothing * rate + (1 - self.smoothing) * previous
+            metrics.token_budget.set(self.budget_of(model), model=model)
+
+    def budget_of(self, model):
+        rate = self.rates.get(model)
+        if rate is None:
+            return self.initial_tokens
+        return int(min(max(self.target_seconds / rate, self.min_tokens), self.max_tokens))
+
+    def budget(self, model):
+        with self.lock:
+            if time.monotonic() - self.last_refresh > self.refresh_interval:
+                self.last_refresh = time.monotonic()
+                self.refresh()
+            return self.budget_of(model)
+
+    def split(self, model, posts):
+        # yields slices of the posts (in order) within the model's token budget,
+        # a post larger than the budget gets a task of its own
+        budget = self.budget(model)
+        batch = []
+        tokens = 0
+        for p in posts:
+            post_tokens = estimate_tokens(p)
+            if batch and (tokens + post_tokens > budget or len(batch) >= self.max_posts):
+                yield batch
+                batch = []
+                tokens = 0
+            batch.append(p)
+            tokens += post_tokens
+        if batch:
+            yield batch
@@ -2,69 +2,163 @@
 
 from scipy.special import softmax
 
-from bilge.sentiment.utils import preprocess
+from bilge import metrics
+from bilge.sentiment.backends import load_backend, versioned_model_id
+
+MAX_LENGTH = 512
+MAX_BATCH_TOKENS = 8192
+WINDOW_STRIDE = 64
+MAX_WINDOWS = 16
+
+
+def split_windows(tokenizer, texts, stride=WINDOW_STRIDE, max_windows=MAX_WINDOWS):
+    """
+        Tokenize the texts into windows of at most MAX_LENGTH tokens, consecutive windows of a text share
+        'stride' tokens and a text is cut after 'max_windows' windows.
+        returns the windows (tokenizer features) and the index of the text of each window
+    """
+    encoded = tokenizer(texts, max_length=MAX_LENGTH, truncation=True, stride=stride,
+                        return_overflowing_tokens=True)
+    owners = encoded.pop('overflow_to_sample_mapping')
+
+    windows = []
+    window_owners = []
+    window_counts = [0] * len(texts)
+    for idx, owner in enumerate(owners):
+        if window_counts[owner] < max_windows:
+            window_counts[owner] += 1
+            windows.append({key: values[idx] for key, values in encoded.items()})
+            window_owners.append(owner)
+    return windows, window_owners
+
+
+def batched_scores(tokenizer, backend, texts, max_batch_tokens=MAX_BATCH_TOKENS, model_id=None,
+                   stride=WINDOW_STRIDE, max_windows=MAX_WINDOWS):
+    """
+        Run the backend on the windows of the texts in length-bucketed, padded batches (windows of
+        different texts share batches), then pool the window scores of each text
+        returns the softmax scores in the same order as 'texts'
+    """
+    with metrics.tokenization_seconds.time(model=model_id):
+        windows, owners = split_windows(tokenizer, texts, stride, max_windows)
+    lengths = [len(w['input_ids']) for w in windows]
+    order = sorted(range(len(windows)), key=lambda i: lengths[i])
+
+    # pack sorted windows into batches, a padded batch costs (batch size * longest window) tokens
+    batches = []
+    batch = []
+    for i in order:
+        if batch and (len(batch) + 1) * lengths[i] > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+
+    window_scores = [None] * len(windows)
+    for batch in batches:
+        with metrics.tokenization_seconds.time(model=model_id):
+            inputs = tokenizer.pad([windows[i] for i in batch], return_tensors=backend.tensor_type)
+        with metrics.model_forward_seconds.time(model=model_id):
+            logits = backend(inputs)
+        for i, s in zip(batch, softmax(logits, axis=1)):
+            window_scores[i] = s
+
+    # average the windows of a text, weighted by the tokens each window adds (not counting the overlap)
+    overlap = stride + tokenizer.num_special_tokens_to_add()
+    scores = [0.0] * len(texts)
+    weights = [0] * len(texts)
+    for s, owner, length in zip(window_scores, owners, lengths):
+        weight = length if weights[owner] == 0 else max(length - overlap, 1)
+        scores[owner] = scores[owner] + s * weight
+        weights[owner] += weight
+
+    return [s / w for s, w in zip(scores, weights)]
 
 
 class EnglishSentimentAnalyzer:
-    def __init__(self):
+    NAME = "cardiffnlp/twitter-roberta-base-sentiment"
+    MODEL = f"models/{NAME}"
+
+    @classmethod
+    def versioned_model_id(cls, backend='torch', quantized=False, **_):
+        # the model id of the analyzer's results, without loading the model
+        return versioned_model_id(cls.NAME, cls.MODEL, backend, quantized)
+
+    def __init__(self, max_batch_tokens=MAX_BATCH_TOKENS, window_stride=WINDOW_STRIDE, max_windows=MAX_WINDOWS,
+                 backend='torch', **backend_options):
         """
             Initialize the sentiment analysis model
+            texts longer than the model's limit are scored in overlapping windows (see batched_scores)
+            backend : 'torch' or 'onnx' (options : quantized, intra_op_threads, inter_op_threads)
         """
-        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+        from transformers import AutoTokenizer
         self.labels = ['negative', 'neutral', 'positive']
+        self.max_batch_tokens = max_batch_tokens
+        self.window_stride = window_stride
+        self.max_windows = max_windows
 
-        MODEL = "models/cardiffnlp/twitter-roberta-base-sentiment"
-        self.tokenizer = AutoTokenizer.from_pretrained(MODEL)
-        self.model = AutoModelForSequenceClassification.from_pretrained(MODEL)
-
-        self.tokenizer.save_pretrained(MODEL)
-        self.model.save_pretrained(MODEL)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.MODEL)
+        self.backend = load_backend(backend, self.MODEL, **backend_options)
+        self.model_id = self.versioned_model_id(backend, **backend_options)
 
     def get_sentiment(self, text):
-        text = preprocess(text)
-        sentiments = {}
-        output = self.model(**self.tokenizer(text, return_tensors='pt', max_length=512, truncation=True))
-        scores = output[0][0].detach().numpy()
-        scores = softmax(scores)
+        return self.get_sentiments([text])[0]
 
-        for idx, s in enumerate(scores):
-            sentiments[self.labels[idx]] = s
+    def get_sentiments(self, texts):
+        # texts are expected to be preprocessed (bilge.sentiment.utils.preprocess)
+        if len(texts) == 0:
+            return []
 
-        return sentiments
+        scores = batched_scores(self.tokenizer, self.backend, texts, self.max_batch_tokens, self.model_id,
+                                self.window_stride, self.max_windows)
 
-    def get_sentiments(self, texts):
-        return [self.get_sentiment(text) for text in texts]
+        return [{label: float(s[idx]) for idx, label in enumerate(self.labels)} for s in scores]
 
 
 class TurkishSentimentAnalyzer:
-    def __init__(self):
+    NAME = "savasy/bert-base-turkish-sentiment-cased"
+    MODEL = f"models/{NAME}"
+
+    @classmethod
+    def versioned_model_id(cls, backend='torch', quantized=False, **_):
+        # the model id of the analyzer's results, without loading the model
+        return versioned_model_id(cls.NAME, cls.MODEL, backend, quantized)
+
+    def __init__(self, max_batch_tokens=MAX_BATCH_TOKENS, window_stride=WINDOW_STRIDE, max_windows=MAX_WINDOWS,
+                 backend='torch', **backend_options):
         """
             Initialize the sentiment analysis model
+            texts longer than the model's limit are scored in overlapping windows (see batched_scores)
+            backend : 'torch' or 'onnx' (options : quantized, intra_op_threads, inter_op_threads)
         """
-        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+        from transformers import AutoTokenizer
         self.labels = ['negative', 'positive']
+        self.max_batch_tokens = max_batch_tokens
+        self.window_stride = window_stride
+        self.max_windows = max_windows
 
-        MODEL = "models/savasy/bert-base-turkish-sentiment-cased"
-        self.tokenizer = AutoTokenizer.from_pretrained(MODEL)
-        self.model = AutoModelForSequenceClassification.from_pretrained(MODEL)
-
-        self.tokenizer.save_pretrained(MODEL)
-        self.model.save_pretrained(MODEL)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.MODEL)
+        self.backend = load_backend(backend, self.MODEL, **backend_options)
+        self.model_id = self.versioned_model_id(backend, **backend_options)
 
         # self.sentiment_analyzer = pipeline("sentiment-analysis", tokenizer=tokenizer, model=model)
 
     def get_sentiment(self, text):
-        text = preprocess(text)
-        sentiments = {}
-        output = self.model(**self.tokenizer(text, return_tensors='pt', max_length=512, truncation=True))
-        scores = output[0][0].detach().numpy()
-        scores = softmax(scores)
+        return self.get_sentiments([text])[0]
 
-        for idx, s in enumerate(scores):
-            sentiments[self.labels[idx]] = s
-        sentiments['neutral'] = None
+    def get_sentiments(self, texts):
+        # texts are expected to be preprocessed (bilge.sentiment.utils.preprocess)
+        if len(texts) == 0:
+            return []
 
-        return sentiments
+        scores = batched_scores(self.tokenizer, self.backend, texts, self.max_batch_tokens, self.model_id,
+                                self.window_stride, self.max_windows)
 
-    def get_sentiments(self, texts):
-        return [self.get_sentiment(text) for text in texts]
+        sentiments = []
+        for s in scores:
+            sentiment = {label: float(s[idx]) for idx, label in enumerate(self.labels)}
+            sentiment['neutral'] = None
+            sentiments.append(sentiment)
+
+        return sentiments
@@ -0,0 +1,89 @@
+# (c) 2021 Emir Erbasan (humanova)
+
+import json
+import os
+
+from bilge.logger import logging
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE = "model.int8.onnx"
+# pytorch weights saved by models/download_models.py (the onnx models are exported from them),
+# transformers 4.6 only reads pytorch_model.bin
+WEIGHTS_FILES = ("pytorch_model.bin",)
+# digests of the model files, written by models/download_models.py when it saves or exports them
+MANIFEST_FILE = "bilge_manifest.json"
+
+
+def read_manifest(model_path):
+    try:
+        with open(os.path.join(model_path, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def versioned_model_id(name, model_path, backend='torch', quantized=False):
+    """
+        "<name>@<digest of the weights the backend runs>", so that an in-place update of a model's weights
+        gets a new model id (the results cache and the re-analysis job tell the models apart by their ids).
+        The digests are read from the model's manifest, the files aren't hashed at load time
+    """
+    manifest = read_manifest(model_path)
+    if backend == 'onnx':
+        files = (ONNX_QUANTIZED_MODEL_FILE if quantized else ONNX_MODEL_FILE,)
+    else:
+        files = WEIGHTS_FILES
+    digest = next((manifest[f] for f in files if f in manifest), None)
+    if digest is None:
+        logging.warning(f"[Bilge] No digest of {'/'.join(files)} in {model_path}/{MANIFEST_FILE}, "
+                        f"the model id is unversioned (run models/download_models.py --manifest)")
+    model_id = f"{name}@{digest}" if digest else name
+    return f"{model_id}:int8" if quantized else model_id
+
+
+class TorchBackend:
+    tensor_type = 'pt'
+
+    def __init__(self, model_path):
+        """
+            Eager pytorch inference
+        """
+        from transformers import AutoModelForSequenceClassification
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_path, low_cpu_mem_usage=True)
+        self.model.eval()
+
+    def __call__(self, inputs):
+        import torch
+        with torch.inference_mode():
+            return self.model(**inputs)[0].numpy()
+
+
+class OnnxBackend:
+    tensor_type = 'np'
+
+    def __init__(self, model_path, quantized=False, intra_op_threads=0, inter_op_threads=0):
+        """
+            ONNX Runtime inference on the model exported by models/download_models.py
+            (0 threads lets onnxruntime decide)
+        """
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+
+        model_file = ONNX_QUANTIZED_MODEL_FILE if quantized else ONNX_MODEL_FILE
+        self.session = onnxruntime.InferenceSession(f"{model_path}/{model_file}", options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, inputs):
+        feed = {name: inputs[name].astype('int64') for name in self.input_names}
+        return self.session.run(None, feed)[0]
+
+
+def load_backend(name, model_path, **options):
+    if name == 'torch':
+        return TorchBackend(model_path)
+    elif name == 'onnx':
+        return OnnxBackend(model_path, **options)
+    raise ValueError(f"Unknown sentiment backend : {name}")
@@ -1,24 +1,43 @@
 # (c) 2021 Emir Erbasan (humanova)
 import logging
+import re
 
 ignore_list = ['http', 'www.', '---']
 modify_list = [('@', '@user')]
 
 
+def compile_preprocessor(ignore_list, modify_list):
+    """
+        Build a single-pass preprocessor from the rules :
+        space separated tokens starting with an 'ignore_list' prefix are emptied,
+        tokens starting with a 'modify_list' prefix are replaced (ignore rules come first).
+        Tokens that are already a replacement are left alone, so applying it twice is a no-op
+    """
+    alternatives = ['(?P<ignore>(?:' + '|'.join(re.escape(i) for i in ignore_list) + ')[^ ]*)'] if ignore_list else []
+    replacements = {}
+    for idx, (c, m) in enumerate(modify_list):
+        group = f'modify{idx}'
+        replacements[group] = m
+        alternatives.append(f'(?P<{group}>(?!{re.escape(m)}(?: |$)){re.escape(c)}[^ ]*)')
+
+    if not alternatives:
+        return lambda text: text
+
+    # a token starts at the beginning of the text or after a space
+    pattern = re.compile('(?<![^ ])(?:' + '|'.join(alternatives) + ')')
+
+    def replace(match):
+        return '' if match.lastgroup == 'ignore' else replacements[match.lastgroup]
+
+    return lambda text: pattern.sub(replace, text)
+
+
+_preprocess = compile_preprocessor(ignore_list, modify_list)
+
+
 def preprocess(text):
-    new_text = []
-    for t in text.split(" "):
-        curr_t = None
-
-        for c, m in modify_list:
-            if t.startswith(c):
-                curr_t = m
-                break
-
-        for ig_text in ignore_list:
-            if t.startswith(ig_text):
-                curr_t = ''
-                break
-
-        new_text.append(t) if curr_t is None else new_text.append(curr_t)
-    return " ".join(new_text)
+    return _preprocess(text)
+
+
+def preprocess_many(texts):
+    return [_preprocess(text) for text in texts]
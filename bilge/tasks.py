@@ -1,37 +1,158 @@
 # (c) 2021 Emir Erbasan (humanova)
 
+import os
 import sys
+import threading
+import time
 import traceback
+from functools import partial
 
+import redis
 from celery import Celery
+from celery.signals import task_failure, task_postrun, task_prerun, worker_process_init
 
 import bilge
-from bilge import database
+from bilge import database, metrics, profiler
+from bilge.cache import InferenceCache
+from bilge.dedup import NearDuplicateIndex
+from bilge.inference import RemoteAnalyzer
 from bilge.logger import logging
+from bilge.payload import decode_payload, encode_payload, payload_language, payload_size
+from bilge.scheduling import TokenBudgetScheduler, estimate_tokens
 from bilge.sentiment.analyzers import TurkishSentimentAnalyzer, EnglishSentimentAnalyzer
 from bilge.ner.analyzers import EnglishNERAnalyzer
-from bilge.sentiment.utils import preprocess
+from bilge.sentiment.utils import preprocess, preprocess_many
 
 config = bilge.config
 
 app = Celery("bilge", broker=f'redis://{config.redis_host}:{config.redis_port}/{config.redis_db}',
              backend=f'redis://{config.redis_host}:{config.redis_port}/{config.redis_db}')
 
+# inference tasks are long running : take one task at a time, acknowledge after it's done
+app.conf.update(worker_prefetch_multiplier=getattr(config, 'worker_prefetch_multiplier', 1),
+                task_acks_late=getattr(config, 'task_acks_late', True),
+                broker_transport_options={'visibility_timeout': getattr(config, 'task_visibility_timeout', 3600)})
+
+# compact task payloads (see bilge.payload), the results of the fire-and-forget tasks aren't stored
+task_payload = getattr(config, 'task_payload', 'dict')
+app.conf.update(task_ignore_result=getattr(config, 'task_ignore_result', True),
+                accept_content=['json', 'msgpack'])
+
+# a batch whose db write lost a deadlock/serialization conflict was rolled back, it's run again
+retry_options = {'autoretry_for': (database.RetryableError,), 'retry_backoff': True,
+                 'max_retries': getattr(config, 'task_max_retries', 5)}
+
 IN_CELERY_WORKER_PROCESS = sys.argv \
                            and sys.argv[0].endswith('celery') \
                            and 'worker' in sys.argv
 
-# init analyzers if we are in a celery worker
-tr_sentiment_analyzer = None
-en_sentiment_analyzer = None
-en_ner_analyzer = None
-tr_ner_analyzer = None
+sentiment_options = {'max_batch_tokens': getattr(config, 'sentiment_max_batch_tokens', 8192),
+                     'window_stride': getattr(config, 'sentiment_window_stride', 64),
+                     'max_windows': getattr(config, 'sentiment_max_windows', 16),
+                     'backend': getattr(config, 'sentiment_backend', 'torch')}
+if sentiment_options['backend'] == 'onnx':
+    sentiment_options.update(quantized=getattr(config, 'sentiment_onnx_quantized', False),
+                             intra_op_threads=getattr(config, 'sentiment_intra_op_threads', 0),
+                             inter_op_threads=getattr(config, 'sentiment_inter_op_threads', 0))
+
+# analyzers are loaded on first use, per (task type, language)
+analyzer_factories = {
+    ('sentiment', 'en'): lambda: EnglishSentimentAnalyzer(**sentiment_options),
+    ('sentiment', 'tr'): lambda: TurkishSentimentAnalyzer(**sentiment_options),
+    ('ner', 'en'): lambda: EnglishNERAnalyzer(batch_size=getattr(config, 'ner_batch_size', 32),
+                                              n_process=getattr(config, 'ner_n_process', 1),
+                                              window_chars=getattr(config, 'ner_window_chars', 2000),
+                                              window_overlap=getattr(config, 'ner_window_overlap', 200)),
+    #('ner', 'tr'): lambda: TurkishNERAnalyzer(),
+}
+analyzers = {}
+
+# model ids of the analyzers' results, resolved without loading the models
+model_ids = {
+    ('sentiment', 'en'): lambda: EnglishSentimentAnalyzer.versioned_model_id(**sentiment_options),
+    ('sentiment', 'tr'): lambda: TurkishSentimentAnalyzer.versioned_model_id(**sentiment_options),
+    ('ner', 'en'): lambda: EnglishNERAnalyzer.versioned_model_id(),
+}
+
+def get_analyzer(task, language):
+    # returns None if there is no analyzer for the language,
+    # with 'inference_server' the models run in the shared inference servers (bilge.inference)
+    key = (task, language)
+    if key not in analyzers:
+        if key not in analyzer_factories:
+            return None
+        if getattr(config, 'inference_server', False):
+            analyzers[key] = RemoteAnalyzer(task, language, retries=getattr(config, 'inference_retries', 5),
+                                            backoff=getattr(config, 'inference_retry_backoff', 0.5))
+            return analyzers[key]
+
+        start = time.perf_counter()
+        analyzers[key] = analyzer_factories[key]()
+        logging.info(f'[Bilge:Tasks] Loaded the {task} analyzer ({language}) in {time.perf_counter() - start:.2f}s')
+    return analyzers[key]
+
+def get_preload_list():
+    # analyzers to load at worker startup : BILGE_PRELOAD env variable (e.g. "ner:en,sentiment:tr")
+    # or 'worker_preload' in the config, "all" loads every analyzer
+    preload = os.environ.get('BILGE_PRELOAD')
+    preload = preload.split(',') if preload is not None else list(getattr(config, 'worker_preload', []))
+    if 'all' in preload:
+        return list(analyzer_factories)
+    return [tuple(p.strip().split(':')) for p in preload if p.strip()]
+
+# preload before the pool forks, so the worker processes share the weights
+if IN_CELERY_WORKER_PROCESS and not getattr(config, 'inference_server', False):
+    for task, language in get_preload_list():
+        get_analyzer(task, language)
+
+# -- instrumentation --
+# each worker process serves its metrics on (worker_metrics_port + process index),
+# BILGE_METRICS_PORT overrides the base port (e.g. per worker pool)
+@worker_process_init.connect
+def start_metrics_server(**kwargs):
+    from billiard.process import current_process
+    port = int(os.environ.get('BILGE_METRICS_PORT', getattr(config, 'worker_metrics_port', 0)))
+    if port:
+        metrics.start_server(port + (current_process().index or 0))
+
+task_start_times = {}
+task_profilers = {}
+
+@task_prerun.connect
+def before_task(task_id=None, task=None, args=None, **kwargs):
+    task_start_times[task_id] = time.perf_counter()
+    if args and isinstance(args[0], (list, dict)):
+        metrics.batch_size.observe(payload_size(args[0]), task=task.name)
+
+    # sample the task's stack if it's listed in 'profile_tasks'
+    if task.name.rsplit('.', 1)[-1] in getattr(config, 'profile_tasks', []):
+        task_profilers[task_id] = profiler.SamplingProfiler(threading.get_ident(),
+                                                            getattr(config, 'profile_interval', 0.005))
+        task_profilers[task_id].start()
+
+@task_postrun.connect
+def after_task(task_id=None, task=None, **kwargs):
+    database.release_connection()
 
-if IN_CELERY_WORKER_PROCESS:
-    tr_sentiment_analyzer = TurkishSentimentAnalyzer()
-    en_sentiment_analyzer = EnglishSentimentAnalyzer()
-    en_ner_analyzer = EnglishNERAnalyzer()
-    #tr_ner_analyzer = TurkishSentimentAnalyzer()
+    start = task_start_times.pop(task_id, None)
+    if start is not None:
+        metrics.task_seconds.observe(time.perf_counter() - start, task=task.name)
+
+    task_profiler = task_profilers.pop(task_id, None)
+    if task_profiler is not None:
+        task_profiler.stop()
+        profiler.log_profile(task_profiler, profiler.dump_path(getattr(config, 'profile_dir', 'profiles'),
+                                                               task.name, task_id))
+
+@task_failure.connect
+def on_task_failure(task_id=None, sender=None, **kwargs):
+    metrics.task_failures.inc(task=sender.name)
+
+# analysis results cache and near-duplicate index, one per model (see cached_inference)
+redis_client = redis.Redis(host=config.redis_host, port=config.redis_port, db=config.redis_db)
+inference_caches = {}
+near_duplicate_indexes = {}
+cache_enabled = getattr(config, 'cache_enabled', True)
 
 # if these sources doesn't contain a proper 'text' then skip them
 # for other sources, we will try to use their 'title's
@@ -44,34 +165,73 @@ def fix_sentence_ending(text):
     new_text += '.' if text[-1] not in sentence_ending_punctuations else ''
     return new_text
 
-@app.task
-def calculate_and_insert_sentiments(posts):
+def cached_inference(analyzer, texts, compute, reuse_near_duplicates=False, use_cache=None):
+    # look up the results of near-duplicate texts (if the caller opts in), then of repeated texts
+    # before running the model. near-duplicate results are approximate, they never reach the exact cache.
+    # 'use_cache' overrides 'cache_enabled' (the bulk cli runs without redis)
+    if use_cache is None:
+        use_cache = cache_enabled
+    if use_cache:
+        if analyzer.model_id not in inference_caches:
+            inference_caches[analyzer.model_id] = InferenceCache(
+                analyzer.model_id, redis_client,
+                lru_size=getattr(config, 'cache_lru_size', 10000),
+                ttl=getattr(config, 'cache_redis_ttl', 86400),
+                max_entries=getattr(config, 'cache_redis_max_entries', 500000))
+        compute = partial(inference_caches[analyzer.model_id].get_or_compute, compute=compute)
+
+    if not reuse_near_duplicates or not getattr(config, 'neardup_enabled', True):
+        return compute(texts)
+
+    if analyzer.model_id not in near_duplicate_indexes:
+        near_duplicate_indexes[analyzer.model_id] = NearDuplicateIndex(
+            analyzer.model_id,
+            threshold=getattr(config, 'neardup_threshold', 0.9),
+            max_entries=getattr(config, 'neardup_max_entries', 50000),
+            min_tokens=getattr(config, 'neardup_min_tokens', 8))
+    return near_duplicate_indexes[analyzer.model_id].get_or_compute(texts, compute)
+
+def calculate_sentiments(posts, use_cache=None):
     # calculate the sentiments of the posts
     # (except the ones without any meaningful text)
+    # returns (sentiments, inapplicable posts)
     sentiment_data = []
     inapplicable_posts = []
-    for p in posts:
-        if p['language'] is None:
-            continue
-
-        text = preprocess(p['text']).strip()
+    language_groups = {}
+    # posts in languages without an analyzer are skipped
+    posts = [p for p in posts if route_language('sentiment', p['language']) is not None]
+    for p, text in zip(posts, preprocess_many([p['text'] for p in posts])):
+        text = text.strip()
         # try using the post 'title' instead of 'text'
         if len(text) == 0 and p['source'] not in sources_with_inapplicable_titles:
             text = preprocess(p['title']).strip()
 
         if len(text) > 0:
-            try:
-                analyzer = en_sentiment_analyzer if p['language'] == 'en' else tr_sentiment_analyzer
-                sentiment = analyzer.get_sentiment(text)
-                sentiment['post_id'] = p['id']
-                sentiment_data.append(sentiment)
-            except Exception as e:
-                logging.warning(f'[Bilge:Tasks] Could not calculate the sentiment : {e}\ncurrent post data : {p}')
-                traceback.print_tb(e.__traceback__)
+            language_groups.setdefault(p['language'], []).append((p, text))
         else:
             inapplicable_posts.append({'post_id': p['id']})
             continue
 
+    # run each language group through its analyzer as a single batch
+    for language, group in language_groups.items():
+        analyzer = get_analyzer('sentiment', language)
+        try:
+            # a near-duplicate's scores are close enough, its entities (and their offsets) wouldn't be
+            sentiments = cached_inference(analyzer, [text for _, text in group], analyzer.get_sentiments,
+                                          reuse_near_duplicates=True, use_cache=use_cache)
+            for (p, _), sentiment in zip(group, sentiments):
+                sentiment['post_id'] = p['id']
+                sentiment['model'] = analyzer.model_id
+                sentiment_data.append(sentiment)
+        except Exception as e:
+            logging.warning(f'[Bilge:Tasks] Could not calculate the sentiments : {e}\n'
+                            f'current post ids : {[p["id"] for p, _ in group]}')
+            traceback.print_tb(e.__traceback__)
+
+    return sentiment_data, inapplicable_posts
+
+
+def insert_sentiments(sentiment_data, inapplicable_posts):
     # insert to sentiment table, delete from nlp_inapplicable
     if len(sentiment_data) > 0:
         database.db.add_post_sentiments(sentiment_data)
@@ -83,22 +243,33 @@ def calculate_and_insert_sentiments(posts):
         database.db.delete_post_sentiments([p['post_id'] for p in inapplicable_posts])
 
 
-@app.task
-def calculate_and_insert_named_entities(posts):
+@app.task(**retry_options)
+def calculate_and_insert_sentiments(payload):
+    start = time.perf_counter()
+    posts = decode_payload(payload)
+    insert_sentiments(*calculate_sentiments(posts))
+    record_task_cost('sentiment', posts, time.perf_counter() - start)
+
+
+def calculate_named_entities(posts, use_cache=None):
     # find the named entities mentioned in the posts
     # (except the ones without any meaningful text)
+    # returns (named entities, ids of the analyzed posts, inapplicable posts)
     ner_data = []
+    analyzed_post_ids = []
     inapplicable_posts = []
-    for p in posts:
-        # TODO: implement the turkish ner analyzer (research time)
-        if p['language'] is None or p['language'] == 'tr':
-            continue
-
+    language_groups = {}
+    # posts in languages without an analyzer are skipped
+    # TODO: implement the turkish ner analyzer (research time)
+    posts = [p for p in posts if route_language('ner', p['language']) is not None]
+    titles = preprocess_many([p['title'] for p in posts])
+    texts = preprocess_many([p['text'] for p in posts])
+    for p, title, text in zip(posts, titles, texts):
         sequence = ""
         # if 'title' and 'text' are applicable for nlp, then use both by concatenating
         # if only 'title' is applicable then use 'title'
-        title = preprocess(p['title']).strip()
-        text = preprocess(p['text']).strip()
+        title = title.strip()
+        text = text.strip()
         
         if len(title) != 0 and p['source'] not in sources_with_inapplicable_titles:
             sequence += fix_sentence_ending(title)
@@ -106,26 +277,111 @@ def calculate_and_insert_named_entities(posts):
             sequence += text
             
         if len(sequence) > 0:
-            try:
-                analyzer = en_ner_analyzer if p['language'] == 'en' else tr_ner_analyzer
-                entities = analyzer.get_named_entities(sequence)
-                for entity in entities:
-                    #if entity['label'] in ner_labels:
-                    entity['post_id'] = p['id']
-                    ner_data.append(entity)
-            except Exception as e:
-                logging.warning(f'[Bilge:Tasks] Could not find the named entities : {e}\ncurrent post data : {p}')
-                traceback.print_tb(e.__traceback__)
+            language_groups.setdefault(p['language'], []).append((p, sequence))
         else:
             inapplicable_posts.append({'post_id': p['id']})
             continue
 
-    # insert to named_entity table, delete from nlp_inapplicable
-    if len(ner_data) > 0:
-        database.db.add_post_named_entities(ner_data)
-        database.db.delete_post_nlpinapplicabilities([p['post_id'] for p in ner_data])
+    # stream each language group through its analyzer as a single pipe call
+    for language, group in language_groups.items():
+        analyzer = get_analyzer('ner', language)
+        try:
+            entities = cached_inference(analyzer, [sequence for _, sequence in group],
+                                        lambda texts: list(analyzer.get_named_entities_batch(texts)),
+                                        use_cache=use_cache)
+            for (p, _), post_entities in zip(group, entities):
+                analyzed_post_ids.append(p['id'])
+                for entity_text, label, _, _ in post_entities:
+                    #if label in ner_labels:
+                    ner_data.append({'post_id': p['id'], 'entity': entity_text, 'label': label,
+                                     'model': analyzer.model_id})
+        except Exception as e:
+            logging.warning(f'[Bilge:Tasks] Could not find the named entities : {e}\n'
+                            f'current post ids : {[p["id"] for p, _ in group]}')
+            traceback.print_tb(e.__traceback__)
+
+    return ner_data, analyzed_post_ids, inapplicable_posts
+
+
+def insert_named_entities(ner_data, analyzed_post_ids, inapplicable_posts):
+    # replace the posts' named entities, delete from nlp_inapplicable
+    if len(analyzed_post_ids) > 0:
+        database.db.add_post_named_entities(ner_data, post_ids=analyzed_post_ids)
+        database.db.delete_post_nlpinapplicabilities(analyzed_post_ids)
 
     # insert to nlp_inapplicable post
     if len(inapplicable_posts) > 0:
         database.db.add_post_nlpinapplicabilities(inapplicable_posts)
-        database.db.delete_post_named_entities([p['post_id'] for p in inapplicable_posts])
\ No newline at end of file
+        database.db.delete_post_named_entities([p['post_id'] for p in inapplicable_posts])
+
+
+@app.task(**retry_options)
+def calculate_and_insert_named_entities(payload):
+    start = time.perf_counter()
+    posts = decode_payload(payload)
+    insert_named_entities(*calculate_named_entities(posts))
+    record_task_cost('ner', posts, time.perf_counter() - start)
+
+
+# -- routing --
+# posts are sent to one queue per (task type, language), e.g. "sentiment.en"
+task_types = {calculate_and_insert_sentiments.name: 'sentiment',
+              calculate_and_insert_named_entities.name: 'ner'}
+
+def route_language(task_type, language):
+    # language of the analyzer that handles the posts, None if there is none
+    # (posts are never sent to another language's model)
+    return language if (task_type, language) in analyzer_factories else None
+
+def supported_languages(task_type):
+    return [language for t, language in analyzer_factories if t == task_type]
+
+def model_languages(task_type, model_id):
+    # languages whose analyzer produces 'model_id' (read from the models' manifests and versions)
+    return [language for language in supported_languages(task_type)
+            if model_ids[(task_type, language)]() == model_id]
+
+def queue_name(task_type, language):
+    return f'{task_type}.{language}'
+
+def all_queues():
+    return [queue_name(task_type, language) for task_type, language in analyzer_factories]
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    task_type = task_types.get(name)
+    if task_type is None or not args or not args[0]:
+        return None
+    language = route_language(task_type, payload_language(args[0]))
+    return {'queue': queue_name(task_type, language)} if language is not None else None
+
+scheduler = TokenBudgetScheduler(redis_client,
+                                 target_seconds=getattr(config, 'scheduler_target_task_seconds', 5.0),
+                                 initial_tokens=getattr(config, 'scheduler_initial_tokens', 8192),
+                                 min_tokens=getattr(config, 'scheduler_min_tokens', 512),
+                                 max_tokens=getattr(config, 'scheduler_max_tokens', 65536),
+                                 max_posts=getattr(config, 'scheduler_max_posts', 256),
+                                 refresh_interval=getattr(config, 'scheduler_refresh_interval', 30),
+                                 smoothing=getattr(config, 'scheduler_smoothing', 0.3))
+
+def record_task_cost(task_type, posts, seconds):
+    # per model cost, for the token budgets of send_posts (a task's posts are of one language)
+    if posts:
+        scheduler.record(queue_name(task_type, posts[0]['language']), sum(estimate_tokens(p) for p in posts), seconds)
+
+def send_posts(task, posts):
+    # split the posts by language and send each group to its queue in tasks of about the same cost
+    # (see TokenBudgetScheduler), posts without an analyzer are dropped here (the task would skip them).
+    # the tasks carry the posts in the 'task_payload' format (see bilge.payload)
+    task_type = task_types[task.name]
+    groups = {}
+    for p in posts:
+        language = route_language(task_type, p['language'])
+        if language is not None:
+            groups.setdefault(language, []).append(p)
+
+    for language, group in groups.items():
+        for batch in scheduler.split(queue_name(task_type, language), group):
+            task.apply_async((encode_payload(batch, task_payload),),
+                             serializer='msgpack' if task_payload == 'packed' else 'json')
+
+app.conf.task_routes = (route_task,)
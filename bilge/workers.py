@@ -0,0 +1,69 @@
+# (c) 2021 Emir Erbasan (humanova)
+#  Launches the celery worker pools described by 'worker_pools' in the config
+
+import os
+import signal
+import subprocess
+import sys
+
+import bilge
+from bilge.inference import model_list, wait_for_servers
+from bilge.logger import logging
+from bilge.tasks import all_queues
+
+config = bilge.config
+
+
+def pool_commands():
+    # returns (pool name, command, environment) for each pool,
+    # without 'worker_pools' a single worker consumes every queue (like the old worker.sh)
+    # with 'inference_server', the models are served by bilge.inference and the workers only forward texts
+    commands = []
+    if getattr(config, 'inference_server', False):
+        commands.append(('inference', [sys.executable, '-m', 'bilge.inference'], dict(os.environ)))
+
+    pools = getattr(config, 'worker_pools', None)
+    if not pools:
+        commands.append(('bilge', worker_command('bilge', ['celery'] + all_queues(), 1), dict(os.environ)))
+        return commands
+
+    for pool in pools:
+        env = dict(os.environ)
+        env['BILGE_PRELOAD'] = ','.join(getattr(pool, 'preload', []))
+        if getattr(pool, 'metrics_port', None):
+            env['BILGE_METRICS_PORT'] = str(pool.metrics_port)
+        commands.append((pool.name, worker_command(pool.name, pool.queues, pool.concurrency), env))
+    return commands
+
+
+def worker_command(name, queues, concurrency):
+    return ['celery', '-A', 'bilge.tasks', 'worker', '--loglevel=INFO', f'--logfile=worker-{name}.log',
+            f'--concurrency={concurrency}', '-Q', ','.join(queues), '-n', f'{name}@%h']
+
+
+if __name__ == "__main__":
+    processes = []
+    for name, command, env in pool_commands():
+        logging.info(f'[Bilge:Workers] Starting pool "{name}" : {" ".join(command)}')
+        processes.append(subprocess.Popen(command, env=env))
+
+        if name == 'inference':
+            # the pools start once every model is served, their first tasks would fail otherwise
+            timeout = getattr(config, 'inference_startup_timeout', 600)
+            missing = wait_for_servers(model_list(), timeout=timeout)
+            if missing:
+                logging.error(f'[Bilge:Workers] The inference servers of {missing} did not start in {timeout}s')
+                processes[-1].terminate()
+                sys.exit(1)
+            logging.info('[Bilge:Workers] The inference servers are ready')
+
+    def stop(signum, frame):
+        # celery does a warm shutdown on SIGTERM
+        for p in processes:
+            p.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for p in processes:
+        p.wait()
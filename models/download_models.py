@@ -1,10 +1,35 @@
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
+import hashlib
+import json
+import os
 import subprocess
 import sys
+import urllib.request
 
 SENTIMENT_EN = "cardiffnlp/twitter-roberta-base-sentiment"
 SENTIMENT_TR = "savasy/bert-base-turkish-sentiment-cased"
 NER_EN = "en_core_web_trf"
+# fasttext language identification model, read by bilge.langid
+LANGID_URL = "https://dl.fbaipublicfiles.com/fasttext/supervised-models/lid.176.ftz"
+LANGID_FILE = "lid.176.ftz"
+
+# file names read by bilge.sentiment.backends.OnnxBackend
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE = "model.int8.onnx"
+WEIGHTS_FILE = "pytorch_model.bin"
+# digests of the model files, read by bilge.sentiment.backends.versioned_model_id (the model ids of the results)
+MANIFEST_FILE = "bilge_manifest.json"
+
+# sample texts for the onnx/pytorch accuracy-parity check
+PARITY_TEXTS = {
+    SENTIMENT_EN: ["I love this, what a great day!", "The service was terrible and slow.",
+                   "The meeting is scheduled for 3pm on Monday.", "@user not sure how I feel about the new update",
+                   "Bitcoin drops 10% after the announcement, investors are worried."],
+    SENTIMENT_TR: ["Bu film gerçekten harikaydı, herkese tavsiye ederim.", "Hizmet çok kötüydü, bir daha gelmem.",
+                   "Toplantı pazartesi saat üçte yapılacak.", "Yeni güncelleme hakkında ne düşüneceğimi bilmiyorum.",
+                   "Dolar kuru açıklamanın ardından yükseldi, yatırımcılar endişeli."],
+}
+MAX_DIFF = {ONNX_MODEL_FILE: 1e-3, ONNX_QUANTIZED_MODEL_FILE: 0.1}
 
 def dl_pretrained_hf_models(models):
     for m in models:
@@ -13,17 +38,110 @@ def dl_pretrained_hf_models(models):
 
         tokenizer.save_pretrained(m)
         model.save_pretrained(m)
+        update_manifest(m, [WEIGHTS_FILE])
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=6)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def update_manifest(m, files):
+    # records the digests of the model's (existing) 'files', the other entries are kept
+    path = f"{m}/{MANIFEST_FILE}"
+    manifest = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+    for model_file in files:
+        if os.path.exists(f"{m}/{model_file}"):
+            manifest[model_file] = file_digest(f"{m}/{model_file}")
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
 
 def dl_pretrained_spacy_models(models):
     for m in models:
         subprocess.check_call([sys.executable, "-m", "spacy", "download", m])
 
+def dl_langid_model():
+    urllib.request.urlretrieve(LANGID_URL, LANGID_FILE)
+
+def export_onnx_models(models, quantize=False):
+    import torch
+
+    class LogitsOnly(torch.nn.Module):
+        # maps positional onnx inputs to the model's keyword arguments
+        def __init__(self, model, input_names):
+            super().__init__()
+            self.model = model
+            self.input_names = input_names
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(self.input_names, inputs)))[0]
+
+    for m in models:
+        tokenizer = AutoTokenizer.from_pretrained(m)
+        model = AutoModelForSequenceClassification.from_pretrained(m)
+        model.eval()
+
+        inputs = tokenizer(PARITY_TEXTS[m][:2], return_tensors='pt', padding=True)
+        input_names = list(inputs.keys())
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+        dynamic_axes['logits'] = {0: 'batch'}
+        torch.onnx.export(LogitsOnly(model, input_names), tuple(inputs[name] for name in input_names),
+                          f"{m}/{ONNX_MODEL_FILE}", input_names=input_names, output_names=['logits'],
+                          dynamic_axes=dynamic_axes, opset_version=12)
+        check_parity(m, tokenizer, model, ONNX_MODEL_FILE)
+        update_manifest(m, [ONNX_MODEL_FILE])
+
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(f"{m}/{ONNX_MODEL_FILE}", f"{m}/{ONNX_QUANTIZED_MODEL_FILE}",
+                             weight_type=QuantType.QInt8)
+            check_parity(m, tokenizer, model, ONNX_QUANTIZED_MODEL_FILE)
+            update_manifest(m, [ONNX_QUANTIZED_MODEL_FILE])
+
+def check_parity(m, tokenizer, model, model_file):
+    # compare the onnx runtime probabilities against pytorch, fail the export if they diverge
+    import onnxruntime
+    import torch
+    from scipy.special import softmax
+
+    inputs = tokenizer(PARITY_TEXTS[m], return_tensors='pt', padding=True)
+    with torch.inference_mode():
+        expected = softmax(model(**inputs)[0].numpy(), axis=1)
+
+    session = onnxruntime.InferenceSession(f"{m}/{model_file}", providers=['CPUExecutionProvider'])
+    feed = {i.name: inputs[i.name].numpy() for i in session.get_inputs()}
+    actual = softmax(session.run(None, feed)[0], axis=1)
+
+    max_diff = float(abs(expected - actual).max())
+    agreement = float((expected.argmax(axis=1) == actual.argmax(axis=1)).mean())
+    print(f"{m}/{model_file} : max probability diff {max_diff:.5f}, label agreement {agreement:.0%}")
+    if max_diff > MAX_DIFF[model_file]:
+        raise RuntimeError(f"{m}/{model_file} diverges from the pytorch model (max diff {max_diff:.5f})")
+
 if __name__ == "__main__":
     hf_mls = [SENTIMENT_EN, SENTIMENT_TR]
     sp_mls = [NER_EN]
 
+    # --manifest : only record the digests of the models already on disk (e.g. after copying them in place)
+    if "--manifest" in sys.argv:
+        for m in hf_mls:
+            update_manifest(m, [WEIGHTS_FILE, ONNX_MODEL_FILE, ONNX_QUANTIZED_MODEL_FILE])
+        sys.exit(0)
+
     print(f"downloading huggingface models : {', '.join(hf_mls)}...")
     dl_pretrained_hf_models(hf_mls)
 
     print(f"downloading spacy models : {', '.join(sp_mls)}...")
     dl_pretrained_spacy_models(sp_mls)
+
+    print(f"downloading the language identification model : {LANGID_FILE}...")
+    dl_langid_model()
+
+    # --onnx : export the sentiment models for the onnx backend, --quantize : also export int8 versions
+    if "--onnx" in sys.argv or "--quantize" in sys.argv:
+        print(f"exporting onnx models : {', '.join(hf_mls)}...")
+        export_onnx_models(hf_mls, quantize="--quantize" in sys.argv)
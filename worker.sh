@@ -1 +1 @@
-celery -A bilge.tasks worker --loglevel=INFO --logfile worker.log --concurrency=1
+python -m bilge.workers